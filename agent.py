@@ -3,58 +3,152 @@
 This manages the training phase of the off-policy SAC with fixed trade-off coefficient α.
 """
 
-import random
 from collections import deque
+from contextlib import nullcontext
+import multiprocessing as mp
+import threading
+import time
 
-import yaml
 import numpy as np
-
-with open('config.yml', 'r') as ymlfile:
-    cfg = yaml.load(ymlfile, Loader=yaml.FullLoader)
-    seed = cfg['setup']['seed']
-    ymlfile.close()
-    
-random.seed(seed)
-np.random.seed(seed)
-
 import tensorflow as tf
-from tensorflow.keras.optimizers import Adam
-tf.random.set_seed(seed)
+from tensorflow.keras.mixed_precision import LossScaleOptimizer
 
+from utils.apex import SharedBuffer, SharedWeights, run_actor
 from utils.deepnetwork import DeepNetwork
-from utils.memorybuffer import Buffer
+from utils.memorybuffer import Buffer, PrioritizedBuffer
+from utils.policy import NumpyPolicy
+from utils.prefetcher import Prefetcher
+from utils.profiler import Profiler
 
 class SAC:
     """
     Class for the SAC agent
     """
 
-    def __init__(self, env, params):
+    def __init__(self, env, params, buffer_folder=None, n_envs=1, profiler=None, evaluator=None, print_episodes=True):
         """Initialize the agent, its network, optimizer and buffer
 
         Args:
             env (gym): gym environment
             params (dict): agent parameters (e.g.,dnn structure)
+            buffer_folder (str): folder for the 'memmap' buffer storage (e.g., tracker.buffer_save)
+            n_envs (int): n° of envs storing their samples in turn (see train_vectorized)
+            profiler (Profiler): per-phase profiler of the training loop (disabled if None)
+            evaluator (Evaluator): periodic evaluation of the actor (disabled if None)
+            print_episodes (bool): print each episode (e.g., False when watched through the telemetry)
 
         Returns:
             None
         """
         
         self.env = env
+        self.profiler = profiler or Profiler()
+        self.evaluator = evaluator
+        self.print_episodes = print_episodes
 
+        # The optimizers scale the losses of the mixed precision models (see DeepNetwork)
         self.actor = DeepNetwork.build(env, params['actor'], actor=True, name='actor')
-        self.actor_opt = Adam()
-
-        self.critic1 = DeepNetwork.build(env, params['critic'], name='critic1')
-        self.critic2 = DeepNetwork.build(env, params['critic'], name='critic2')
-        self.critic1_tg = DeepNetwork.build(env, params['critic'], name='critic1_tg')
-        self.critic2_tg = DeepNetwork.build(env, params['critic'], name='critic2_tg')
-        self.critic1_tg.set_weights(self.critic1.get_weights())
-        self.critic2_tg.set_weights(self.critic2.get_weights())
-        self.critic1_opt = Adam()
-        self.critic2_opt = Adam()
+        self.actor_opt = DeepNetwork.optimizer(params['actor'])
+
+        # Two separate critics, or a single model with n_critics stacked critics (see DeepNetwork)
+        self.fused_critics = params['critic']['fused']
+        assert self.fused_critics or params['critic']['n_critics'] == 2, 'n_critics != 2 requires fused critics'
+        assert params['critic']['n_critics'] >= 2, 'the clipped double Q target needs n_critics >= 2'
+        if self.fused_critics:
+            self.critic = DeepNetwork.build(env, params['critic'], name='critic')
+            self.critic_tg = DeepNetwork.build(env, params['critic'], name='critic_tg')
+            self.critic_tg.set_weights(self.critic.get_weights())
+            # Adam is elementwise, so one optimizer on the stacked weights updates each critic as its own
+            self.critic_opt = DeepNetwork.optimizer(params['critic'])
+            self.critics = [self.critic]
+            self.critics_tg = [self.critic_tg]
+            self.critic_opts = [self.critic_opt]
+        else:
+            self.critic1 = DeepNetwork.build(env, params['critic'], name='critic1')
+            self.critic2 = DeepNetwork.build(env, params['critic'], name='critic2')
+            self.critic1_tg = DeepNetwork.build(env, params['critic'], name='critic1_tg')
+            self.critic2_tg = DeepNetwork.build(env, params['critic'], name='critic2_tg')
+            self.critic1_tg.set_weights(self.critic1.get_weights())
+            self.critic2_tg.set_weights(self.critic2.get_weights())
+            self.critic1_opt = DeepNetwork.optimizer(params['critic'])
+            self.critic2_opt = DeepNetwork.optimizer(params['critic'])
+            self.critics = [self.critic1, self.critic2]
+            self.critics_tg = [self.critic1_tg, self.critic2_tg]
+            self.critic_opts = [self.critic1_opt, self.critic2_opt]
+
+        # All the critics are paired with their targets, so a single update_target_critics call moves them
+        self.critic_weights = [w for c in self.critics for w in c.variables]
+        self.critic_tg_weights = [w for c in self.critics_tg for w in c.variables]
+
+        # Forward passes of the 'eager' update, compiled with XLA by jit_compile in the actor/critic params.
+        # The 'graph' update is compiled as a whole (update.jit_compile): nested XLA calls would recompile at each step
+        forward = DeepNetwork.forward if params['update']['mode'] == 'eager' else lambda model, _: model
+        self.actor_forward = forward(self.actor, params['actor'])
+        self.critic_forwards = [forward(c, params['critic']) for c in self.critics]
+        self.critic_tg_forwards = [forward(c, params['critic']) for c in self.critics_tg]
         
-        self.buffer = Buffer(params['buffer']['size'])
+        # 'uniform' or 'prioritized' (sum-tree, weighted by the TD errors),
+        # stored in 'memory' or in 'memmap' files inside buffer_folder
+        self.prioritized = params['buffer']['type'] == 'prioritized'
+        if params['buffer']['storage'] == 'memmap':
+            assert buffer_folder is not None, 'memmap storage requires a buffer folder'
+        else:
+            buffer_folder = None
+
+        # Compact storage: states/actions type and obs_states recovered from the next states
+        storage = dict(
+            folder=buffer_folder,
+            dtype=params['buffer']['dtype'],
+            shared_next=params['buffer']['shared_next'],
+            stride=n_envs
+        )
+
+        if self.prioritized:
+            self.buffer = PrioritizedBuffer(
+                params['buffer']['size'],
+                env.observation_space.shape,
+                env.action_space.shape,
+                params['buffer']['priority_alpha'],
+                params['buffer']['priority_beta'],
+                **storage
+            )
+        else:
+            self.buffer = Buffer(
+                params['buffer']['size'],
+                env.observation_space.shape,
+                env.action_space.shape,
+                **storage
+            )
+
+        # 'eager' runs update_continuous + polyak_update step by step,
+        # 'graph' runs the whole step as a single compiled call (optionally with XLA)
+        self.update_mode = params['update']['mode']
+        assert self.update_mode in ['eager', 'graph']
+        if self.update_mode == 'graph':
+            # The batches have a static shape (see sample_batch), so it is traced (and compiled by XLA) once
+            self.train_step = tf.function(
+                self.fused_update, 
+                jit_compile=params['update']['jit_compile']
+            )
+
+        # 'keras' calls the actor model, 'function' a compiled concrete function,
+        # 'numpy' a NumPy copy of the actor refreshed every inference_refresh updates
+        self.inference = params['actor']['inference']
+        assert self.inference in ['keras', 'function', 'numpy']
+        if self.inference == 'function':
+            self.actor_fn = tf.function(
+                lambda s: self.actor(s, training=False),
+                jit_compile=params['actor']['jit_compile'],
+                input_signature=[tf.TensorSpec((None, *env.observation_space.shape), tf.float32)]
+            ).get_concrete_function()
+        elif self.inference == 'numpy':
+            self.policy = NumpyPolicy(self.actor.get_weights(), env.action_space.high[0])
+            self.inference_refresh = params['actor']['inference_refresh']
+        self.n_updates = 0
+
+        # Update-to-data ratio: grad_steps gradient steps every update_every env steps
+        self.grad_steps = params['update']['grad_steps']
+        self.update_every = params['update']['every']
 
     def get_action(self, state, std):
         """Get the action to perform
@@ -69,39 +163,169 @@ class SAC:
 
         """
 
-        mu = self.actor(np.array([state])).numpy()[0]
-        action = np.random.normal(loc=mu, scale=std)
-        return action
+        return self.get_actions(np.asarray(state, dtype=np.float32)[None], std)[0]
     
-    def update(self, gamma, batch_size, std, alpha):
-        """Prepare the samples to update the network
+    def get_actions(self, states, std):
+        """Get the actions to perform for a batch of states (e.g., one for each env of a vector env)
+
+        Args:
+            states (np.array): agents current states, shape (n° envs, state size)
+            std (float): Gaussian distribution std for action selection
+
+        Returns:
+            actions (np.array): sampled actions to perform, shape (n° envs, action size)
+        """
+
+        if self.inference == 'numpy':
+            mu = self.policy(states)
+        elif self.inference == 'function':
+            mu = self.actor_fn(tf.constant(states, dtype=tf.float32)).numpy()
+        else:
+            mu = self.actor(np.asarray(states)).numpy()
+
+        # Same draws of np.random.normal(loc=mu, scale=std), without the extra broadcasting
+        mu += std * np.random.standard_normal(mu.shape)
+        return mu
+
+    def update(self, gamma, batch_size, std, alpha, tau):
+        """Prepare the samples to update the network and the target networks.
+        A single batch of n° gradient steps * batch_size samples is drawn from the buffer,
+        moved to TF once and then sliced in one minibatch for each gradient step.
+        With the prioritized buffer the critic losses are weighted by the importance sampling
+        weights, and the priorities are updated with the TD errors of each minibatch
 
         Args:
             gamma (float): discount factor
             batch_size (int): batch size for the off-policy A2C
             std (float): Gaussian distribution std for action selection
             alpha (float): tradeoff coefficient
+            tau (float): controls the target networks update rate
 
         Returns:
-            None
+            losses (list): critic1 and critic2 losses of the last gradient step (tensors)
         """
-        
-        batch_size = min(self.buffer.size, batch_size)
-        states, actions, rewards, obs_states, dones = self.buffer.sample(batch_size)
 
+        return self.learn(self.sample_batch(batch_size), gamma, std, alpha, tau)
+
+    def sample_batch(self, batch_size, lock=None):
+        """Draw the samples of a whole update (n° gradient steps * batch_size) and move them to TF
+
+        Args:
+            batch_size (int): batch size for each gradient step
+            lock (threading.Lock): held while reading the buffer (see train_concurrent)
+
+        Returns:
+            batch (tuple): states, actions, rewards, obs_states, dones, weights tensors, 
+                buffer indices (None if uniform) and minibatch size
+        """
+
+        t0 = self.profiler.tic()
+        # Always the full batch_size, drawn with replacement also from the first samples: a growing
+        # batch would retrace the update and recompile its XLA executables for each size
+        with lock or nullcontext():
+            samples = self.buffer.sample(batch_size * self.grad_steps)
+        if self.prioritized:
+            *samples, idx, weights = samples
+        else:
+            idx = None
+            weights = np.ones(batch_size * self.grad_steps, dtype=np.float32)
+        
         # The updates require shape (n° samples, len(metric))
-        rewards = rewards.reshape(-1, 1)
-        dones = dones.reshape(-1, 1)
+        states, actions, rewards, obs_states, dones, weights = \
+            [tf.convert_to_tensor(s) for s in (*samples, weights)]
+        rewards = tf.reshape(rewards, (-1, 1))
+        dones = tf.reshape(dones, (-1, 1))
+        weights = tf.reshape(weights, (-1, 1))
+        self.profiler.toc('buffer_sample', t0)
+
+        return states, actions, rewards, obs_states, dones, weights, idx, batch_size
+
+    def learn(self, batch, gamma, std, alpha, tau, lock=None):
+        """Perform the gradient steps of an update on a batch returned by sample_batch
+
+        Args:
+            batch (tuple): samples returned by sample_batch
+            gamma (float): discount factor
+            std (float): Gaussian distribution std for action selection
+            alpha (float): tradeoff coefficient
+            tau (float): controls the target networks update rate
+            lock (threading.Lock): held while updating the priorities (see train_concurrent)
+
+        Returns:
+            losses (list): critic1 and critic2 losses of the last gradient step (tensors)
+        """
+
+        states, actions, rewards, obs_states, dones, weights, idx, batch_size = batch
+
+        for i in range(self.grad_steps):
+            b = slice(i * batch_size, (i + 1) * batch_size)
+            td_errors, *losses = self.update_step(gamma, std, \
+                states[b], actions[b], rewards[b], obs_states[b], dones[b], alpha, tau, weights[b])
+            
+            if self.prioritized:
+                t0 = self.profiler.tic()
+                td_errors = td_errors.numpy()
+                with lock or nullcontext():
+                    self.buffer.update_priorities(idx[b], td_errors)
+                self.profiler.toc('update_priorities', t0)
+
+        self.n_updates += 1
+        if self.inference == 'numpy' and self.n_updates % self.inference_refresh == 0:
+            self.policy.set_weights(self.actor.get_weights())
 
-        self.update_continuous(gamma, std, \
-            states, actions, rewards, obs_states, dones, alpha)
+        return losses
+
+    def update_step(self, gamma, std, states, actions, rewards, obs_states, dones, alpha, tau, weights):
+        """Perform a single gradient step and the target networks update, in the configured mode
+
+        Args:
+            gamma (float): discount factor
+            std (float): Gaussian distribution std for action selection
+            states (tf.Tensor): minibatch states for the update
+            actions (tf.Tensor): minibatch actions for the update
+            rewards (tf.Tensor): minibatch rewards for the update
+            obs_states (tf.Tensor): minibatch obs_states for the update
+            dones (tf.Tensor): minibatch dones for the update
+            alpha (float): tradeoff coefficient
+            tau (float): controls the target networks update rate
+            weights (tf.Tensor): minibatch importance sampling weights for the critic losses
+
+        Returns:
+            td_errors (tf.Tensor): mean absolute TD error of the two critics for each sample
+            critic1_loss (tf.Tensor): loss of the first critic
+            critic2_loss (tf.Tensor): loss of the second critic
+        """
 
-    def update_continuous(self, gamma, std, states, actions, rewards, obs_states, dones, alpha):
+        t0 = self.profiler.tic()
+        if self.update_mode == 'graph':
+            # Scalars are fed as tensors to avoid retracing when std/alpha change
+            outputs = self.train_step(
+                tf.constant(gamma, dtype=tf.float32), 
+                tf.constant(std, dtype=tf.float32),
+                states, actions, rewards, obs_states, dones, 
+                tf.constant(alpha, dtype=tf.float32), 
+                tf.constant(tau, dtype=tf.float32),
+                weights
+            )
+            self.profiler.toc('fused_update', t0)
+            return outputs
+
+        outputs = self.update_continuous(gamma, std, \
+            states, actions, rewards, obs_states, dones, alpha, weights)
+        self.profiler.toc('update_continuous', t0)
+
+        t0 = self.profiler.tic()
+        self.update_target_critics(tf.constant(tau, dtype=tf.float32))
+        self.profiler.toc('polyak_update', t0)
+        return outputs
+
+    def update_continuous(self, gamma, std, states, actions, rewards, obs_states, dones, alpha, weights):
         """Improved version of TD3. It learns two Q-functions, and uses the smaller Q to form the targets. It uses an entropy term in the update of both the critic and the actor. 
         It uses the current policy to sample the actions. 
         The actor tries to max the state-action values given by the critic, sampling the action 
         a_squash(s|θ) = tanh(μ(s|θ) + δ(s) * N(0, I)), where μ is the network output (i.e., the mean of the Gaussian). So it remove the stochasticity from the action selection, and it squash the actions with a tanh. The policy is then updated with: (minQ(s,a_squash(s|θ)) - α log π(a_squash(s|θ)|θ)) using the min Q between the two critics.
         The critic estimates the min Q_target using the current policy to estimate the next best action. It is then updated in DQN fashion, minimizing mse (Q(s, a) - y). Where y = r + γ * done * (min Q_targ(s', π(s'|θ)) - α log (π(s'|θ)|s')))
+        With the fused critics, the min is over the n_critics critics of the ensemble.
 
         Args:
             gamma (float): discount factor
@@ -112,20 +336,22 @@ class SAC:
             obs_states (list): episode's obs_states for the update
             dones (list): episode's dones for the update
             alpha (float): tradeoff coefficient
+            weights (tf.Tensor): importance sampling weights for the critic losses
 
         Returns:
-            None
+            td_errors (tf.Tensor): mean absolute TD error of the critics for each sample
+            critic1_loss (tf.Tensor): loss of the first critic
+            critic2_loss (tf.Tensor): loss of the second critic
         """
 
-        with tf.GradientTape() as tape_c1, tf.GradientTape() as tape_c2, tf.GradientTape() as tape_a:
-            # Compute π(s'|θ) for the critic target
-            mu = self.actor(obs_states)
+        with tf.GradientTape(persistent=True) as tape_c, tf.GradientTape() as tape_a:
+            # Compute π(s'|θ), used for the critic target and for a_squash(s|θ): the critics 
+            # update does not change the actor, so a single forward pass serves both
+            mu = self.actor_forward(obs_states)
             tg_actions = np.random.normal(loc=mu, scale=std)
 
-            # Compute the Q_targ(s',π(s'|θ))
-            tg1_values = self.critic1_tg([obs_states, tg_actions]).numpy()
-            tg2_values = self.critic2_tg([obs_states, tg_actions]).numpy()
-            min_tg_values = tf.math.minimum(tg1_values, tg2_values)
+            # Compute the min Q_targ(s',π(s'|θ))
+            min_tg_values = tf.math.reduce_min(self.critic_values(obs_states, tg_actions, target=True), axis=0).numpy()
 
             # Compute α log π(π(s'|θ)|s')
             gauss_d = std * tf.sqrt(2 * np.pi)
@@ -142,27 +368,16 @@ class SAC:
             critic_targets = rewards + gamma * min_tg_values * dones
             critic_targets = tf.math.subtract(critic_targets, log_p).numpy()
 
-            # Compute Q(s, a)
-            states_values1 = self.critic1([states, actions])
-            states_values2 = self.critic2([states, actions])
-
-            # Compute the critics loss as target - V(s) using the min target
-            td_error1 = tf.math.subtract(critic_targets, states_values1) 
-            critic1_loss = tf.math.square(td_error1) 
-            critic1_loss = tf.math.reduce_mean(critic1_loss)
+            # Compute the critics loss as target - Q(s, a) using the min target
+            td_errors = tf.math.subtract(critic_targets, self.critic_values(states, actions)) 
+            critic_losses = tf.math.reduce_mean(tf.math.square(td_errors) * weights, axis=[1, 2])
 
-            td_error2 = tf.math.subtract(critic_targets, states_values2) 
-            critic2_loss = tf.math.square(td_error2) 
-            critic2_loss = tf.math.reduce_mean(critic2_loss)
-
-            # Compute the critics gradient and update the network
-            critic1_grad = tape_c1.gradient(critic1_loss, self.critic1.trainable_variables)
-            self.critic1_opt.apply_gradients(zip(critic1_grad, self.critic1.trainable_variables))
-            critic2_grad = tape_c2.gradient(critic2_loss, self.critic2.trainable_variables)
-            self.critic2_opt.apply_gradients(zip(critic2_grad, self.critic2.trainable_variables))
+        # Compute the critics gradient and update the networks, outside of the tapes (see fused_update)
+        self.apply_critic_gradients(tape_c, critic_losses)
+        del tape_c
 
+        with tape_a:
             # Compute a_squash(s|θ) = tanh(μ(s|θ) + δ(s) * N(0, I))   
-            mu = self.actor(obs_states)
             action_squashed = mu + tf.random.normal(shape=mu.shape)
             action_squashed = tf.math.tanh(action_squashed)
 
@@ -177,33 +392,174 @@ class SAC:
             log_p *= alpha    # α = 0.2
 
             # Compute min Q(s,a_squash(s|θ))
-            states_values1 = self.critic1([states, action_squashed]).numpy()
-            states_values2 = self.critic2([states, action_squashed]).numpy()
-            min_tg_values = tf.math.minimum(states_values1, states_values2)
+            min_tg_values = tf.math.reduce_min(self.critic_values(states, action_squashed), axis=0).numpy()
 
             # Compute actor objective max (minQ(s,a_squash(s|θ)) - α log π(a_squash(s|θ)|θ))
             actor_objective = tf.math.subtract(min_tg_values, log_p)
             actor_objective = -tf.math.reduce_mean(actor_objective)
 
-            # Compute the actor gradient and update the network
-            actor_grad = tape_a.gradient(actor_objective, self.actor.trainable_variables)
-            self.actor_opt.apply_gradients(zip(actor_grad, self.actor.trainable_variables))
+        # Compute the actor gradient and update the network
+        self.apply_gradients(tape_a, actor_objective, self.actor.trainable_variables, self.actor_opt)
+
+        # The critics have one output for each action dimension
+        td_errors = tf.math.reduce_mean(tf.math.abs(td_errors), axis=[0, 2])
+        return td_errors, critic_losses[0], critic_losses[1]
+
+    def fused_update(self, gamma, std, states, actions, rewards, obs_states, dones, alpha, tau, weights):
+        """Graph version of update_continuous followed by the polyak updates of the target critics.
+        It computes the same quantities without leaving TensorFlow: the target actions are sampled
+        with tf.random and the values that update_continuous detaches with .numpy() are wrapped in
+        tf.stop_gradient, so the gradients of the two modes match.
+        It is wrapped by tf.function in __init__ (see the 'update' section in config.yml)
+
+        Args:
+            gamma (tf.Tensor): discount factor
+            std (tf.Tensor): Gaussian distribution std for action selection
+            states (np.array): sampled states for the update
+            actions (np.array): sampled actions for the update
+            rewards (np.array): sampled rewards for the update
+            obs_states (np.array): sampled obs_states for the update
+            dones (np.array): sampled dones for the update
+            alpha (tf.Tensor): tradeoff coefficient
+            tau (tf.Tensor): controls the target networks update rate
+            weights (tf.Tensor): importance sampling weights for the critic losses
+
+        Returns:
+            td_errors (tf.Tensor): mean absolute TD error of the critics for each sample
+            critic1_loss (tf.Tensor): loss of the first critic
+            critic2_loss (tf.Tensor): loss of the second critic
+        """
+
+        # A single forward pass of π(s'|θ), for the critic target and for a_squash(s|θ)
+        with tf.GradientTape() as tape_a:
+            mu = self.actor_forward(obs_states)
+
+        # Compute Q_targ(s',π(s'|θ)) for the critic target
+        tg_mu = tf.stop_gradient(mu)
+        tg_actions = tg_mu + std * tf.random.normal(shape=tf.shape(mu))
+        min_tg_values = tf.math.reduce_min(self.critic_values(obs_states, tg_actions, target=True), axis=0)
+
+        # Compute α log π(π(s'|θ)|s')
+        gauss_d = std * tf.sqrt(2 * np.pi)
+        gauss_n = tf.math.exp(-0.5 * ((tg_actions - tg_mu) / std)**2)
+        gauss_p = tf.math.reduce_mean(gauss_n / gauss_d, axis=1, keepdims=True)
+        log_p = alpha * tf.math.log(gauss_p)
+
+        critic_targets = rewards + gamma * min_tg_values * dones
+        critic_targets = tf.stop_gradient(critic_targets - log_p)
+
+        # Update the critics minimizing mse (Q(s, a) - y)
+        with tf.GradientTape(persistent=True) as tape_c:
+            td_errors = critic_targets - self.critic_values(states, actions)
+            critic_losses = tf.math.reduce_mean(tf.math.square(td_errors) * weights, axis=[1, 2])
+
+        self.apply_critic_gradients(tape_c, critic_losses)
+        del tape_c
+
+        # Update the actor with (minQ(s,a_squash(s|θ)) - α log π(a_squash(s|θ)|θ))
+        with tape_a:
+            action_squashed = tf.math.tanh(mu + tf.random.normal(shape=tf.shape(mu)))
+
+            gauss_n = tf.math.exp(-0.5 * ((action_squashed - mu) / std)**2)
+            gauss_p = tf.math.reduce_mean(gauss_n / gauss_d, axis=1, keepdims=True)
+            log_p = alpha * tf.math.log(gauss_p)
+
+            min_values = tf.stop_gradient(tf.math.reduce_min(self.critic_values(states, action_squashed), axis=0))
+
+            actor_objective = -tf.math.reduce_mean(min_values - log_p)
+
+        self.apply_gradients(tape_a, actor_objective, self.actor.trainable_variables, self.actor_opt)
+
+        # Polyak update of the target critics
+        self.update_target_critics(tau)
+
+        # The critics have one output for each action dimension
+        td_errors = tf.math.reduce_mean(tf.math.abs(td_errors), axis=[0, 2])
+        return td_errors, critic_losses[0], critic_losses[1]
+
+    def critic_values(self, states, actions, target=False):
+        """Compute Q(s, a) of all the critics
+
+        Args:
+            states (tf.Tensor): states
+            actions (tf.Tensor): actions
+            target (bool): use the target critics
+
+        Returns:
+            values (tf.Tensor): stacked values, shape (n° critics, batch, action size)
+        """
+
+        critics = self.critic_tg_forwards if target else self.critic_forwards
+        if self.fused_critics: return critics[0]([states, actions])
+        return tf.stack([c([states, actions]) for c in critics])
+
+    def apply_critic_gradients(self, tape, critic_losses):
+        """Update the critics with the gradient of their losses
+
+        Args:
+            tape (tf.GradientTape): persistent tape that recorded the losses
+            critic_losses (tf.Tensor): loss of each critic
+
+        Returns:
+            None
+        """
+
+        # The gradient of the sum of the losses, as each critic affects only its own loss
+        for critic, opt in zip(self.critics, self.critic_opts):
+            self.apply_gradients(tape, critic_losses, critic.trainable_variables, opt)
+
+    @staticmethod
+    def apply_gradients(tape, loss, variables, opt):
+        """Compute the gradient of the loss and update the variables. With a LossScaleOptimizer,
+        the backward pass starts from the loss scale instead of 1 (i.e., the gradient of the scaled loss)
+        and the gradients are unscaled before the update, that is skipped if they are not finite
+
+        Args:
+            tape (tf.GradientTape): tape that recorded the loss
+            loss (tf.Tensor): loss to minimize
+            variables (list): variables to update
+            opt (Optimizer): optimizer of the variables
+
+        Returns:
+            None
+        """
+
+        if isinstance(opt, LossScaleOptimizer):
+            grad = tape.gradient(loss, variables, output_gradients=tf.fill(tf.shape(loss), opt.loss_scale))
+            grad = opt.get_unscaled_gradients(grad)
+        else:
+            grad = tape.gradient(loss, variables)
+        opt.apply_gradients(zip(grad, variables))
 
     @tf.function
     def polyak_update(self, weights, target_weights, tau):
-        """Polyak update for the target networks
+        """Polyak update for the target networks, as a single group of assign ops.
+        tw + τ * (w - tw) is equal to w * τ + tw * (1 - τ) with one op less for each weight
 
         Args:
             weights (list): network weights
             target_weights (list): target network weights
-            tau (float): controls the update rate
+            tau (tf.Tensor): controls the update rate (a tensor, so changing it does not retrace)
 
         Returns:
             None
         """
 
-        for (w, tw) in zip(weights, target_weights):
-            tw.assign(w * tau + tw * (1 - tau))
+        tf.group([tw.assign_add(tau * (w - tw)) for (w, tw) in zip(weights, target_weights)])
+
+    @tf.function
+    def update_target_critics(self, tau):
+        """Polyak update of both target critics. The variables are captured by the traced graph 
+        instead of being passed as lists, which avoids their per-call argument handling
+
+        Args:
+            tau (tf.Tensor): controls the update rate
+
+        Returns:
+            None
+        """
+
+        self.polyak_update(self.critic_weights, self.critic_tg_weights, tau)
 
     def train(self, tracker, n_episodes, verbose, params, hyperp):
         """Main loop for the agent's training phase
@@ -237,56 +593,510 @@ class SAC:
             state = self.env.reset()
 
             while True:
+                t0 = self.profiler.tic()
                 action = self.get_action(state, std)
+                self.profiler.toc('get_action', t0)
+
+                t0 = self.profiler.tic()
                 obs_state, obs_reward, done, _ = self.env.step(action)
+                self.profiler.toc('env_step', t0)
 
+                t0 = self.profiler.tic()
                 self.buffer.store(state, 
                     action,
                     obs_reward, 
                     obs_state, 
                     1 - int(done)
                 )
+                self.profiler.toc('buffer_store', t0)
 
                 ep_reward += obs_reward
                 steps += 1
 
                 state = obs_state
             
-                if steps >= 100:
-                    self.update(                        
+                if steps >= 100 and steps % self.update_every == 0:
+                    losses = self.update(                        
                         params['gamma'], 
                         params['buffer']['batch'],
                         std,
-                        alpha
+                        alpha,
+                        tau
                     )
-                    self.polyak_update(self.critic1.variables, self.critic1_tg.variables, tau)
-                    self.polyak_update(self.critic2.variables, self.critic2_tg.variables, tau)      
+                    # The writer thread converts the loss tensors
+                    tracker.log_step(steps, [steps, *losses, alpha, std])
+                    self.profiler.step(steps, 1, self.grad_steps, tracker, self.buffer)
+                else:
+                    self.profiler.step(steps, 1, 0, tracker, self.buffer)
 
                 if done: break
 
             mean_reward.append(ep_reward)
             tracker.update([e, ep_reward])
+            if self.evaluator is not None: self.evaluator.step(e, self.actor)
 
-            if e % verbose == 0: tracker.save_metrics()
+            if e % verbose == 0: 
+                tracker.save_metrics()
+                self.buffer.flush()
 
-            #DeepNetwork.print_weights(self.critic1)
-            print(f'Ep: {e}, Ep_Rew: {ep_reward}, Mean_Rew: {np.mean(mean_reward)}')
-            print('alpha: {}    std: {}'.format(alpha, std))
+            #DeepNetwork.print_weights(self.critics[0])
+            if self.print_episodes:
+                print(f'Ep: {e}, Ep_Rew: {ep_reward}, Mean_Rew: {np.mean(mean_reward)}')
+                print('alpha: {}    std: {}'.format(alpha, std))
             #print('tau: ' + str(tau))
 
             if std_scale:
-                if std_scaling_type == 'standard_time':
-                    std = max(std_min, std * std_decay)
-                elif std_scaling_type == 'sigmoid_reward':
-                    std = 1/(np.exp(np.mean(mean_reward) / 200) + 1)
-                elif std_scaling_type == 'tanh_time':
-                    std = .5 - np.tanh(e / 100 - 3) / 2
+                std = self.scale_value(std, std_scaling_type, std_decay, std_min, e, mean_reward)
 
             if alpha_scale:
-                if alpha_scaling_type == 'standard_time':
-                    alpha = max(alpha_min, alpha * alpha_decay)
-                elif alpha_scaling_type == 'sigmoid_reward':
-                    alpha = 1/(np.exp(np.mean(mean_reward) / 200) + 1)
-                elif alpha_scaling_type == 'tanh_time':
-                    alpha = .5 - np.tanh(e / 100 - 3) / 2
+                alpha = self.scale_value(alpha, alpha_scaling_type, alpha_decay, alpha_min, e, mean_reward)
+
+    def train_vectorized(self, tracker, envs, n_episodes, verbose, params, hyperp):
+        """Main loop for the agent's training phase with N copies of the environment (gym vector API).
+        Each tick performs a single batched actor forward pass over the N observations, stores
+        N transitions and performs the updates due for those N env steps (as in train).
+        n_episodes counts the episodes terminated by any of the envs, and the std/alpha scaling 
+        is applied after each of them
+
+        Args:
+            tracker (object): used to store and save the training stats
+            envs (gym.vector.VectorEnv): vectorized gym environment (sync or async)
+            n_episodes (int): n° of episodes to perform
+            verbose (int): how frequent we save the training stats
+            params (dict): agent parameters (e.g., the critic's gamma)
+            hyperp (dict): algorithmic specific values (e.g., tau)
+
+        Returns:
+            None
+        """
+
+        mean_reward = deque(maxlen=100)
+
+        tau = hyperp['tau']
+        std, std_scale = hyperp['std'], hyperp['std_scale']
+        std_decay, std_min = params['std_decay'], params['std_min']
+        alpha, alpha_scale = params['alpha'], params['alpha_scale']
+        alpha_min, alpha_decay = params['alpha_min'], params['alpha_decay']
+        alpha_scaling_type = params['alpha_scaling_type']
+        std_scaling_type = params['std_scaling_type']
+
+        steps = 0
+        e = 0
+
+        n_envs = envs.num_envs
+        ep_rewards = np.zeros(n_envs)
+        states = envs.reset()
+
+        while e < n_episodes:
+            t0 = self.profiler.tic()
+            actions = self.get_actions(states, std)
+            self.profiler.toc('get_action', t0)
+
+            t0 = self.profiler.tic()
+            obs_states, obs_rewards, dones, infos = envs.step(actions)
+            self.profiler.toc('env_step', t0)
+
+            t0 = self.profiler.tic()
+            for i in range(n_envs):
+                # The vector env resets the terminated envs, so their obs_state is the reset one
+                obs_state = self.final_observation(infos, i) if dones[i] else obs_states[i]
+                self.buffer.store(states[i], 
+                    actions[i],
+                    obs_rewards[i], 
+                    obs_state, 
+                    1 - int(dones[i])
+                )
+            self.profiler.toc('buffer_store', t0)
+
+            ep_rewards += obs_rewards
+            # N° of update_every boundaries crossed by the N env steps of this tick
+            n_updates = (steps + n_envs) // self.update_every - steps // self.update_every
+            steps += n_envs
+
+            states = obs_states
+
+            if steps < 100: n_updates = 0
+            if n_updates:
+                for _ in range(n_updates):
+                    losses = self.update(
+                        params['gamma'], 
+                        params['buffer']['batch'],
+                        std,
+                        alpha,
+                        tau
+                    )
+                tracker.log_step(steps, [steps, *losses, alpha, std])
+            self.profiler.step(steps, n_envs, n_updates * self.grad_steps, tracker, self.buffer)
+
+            for i in np.flatnonzero(dones):
+                if e >= n_episodes: break
+
+                ep_reward = ep_rewards[i]
+                ep_rewards[i] = 0
+
+                mean_reward.append(ep_reward)
+                tracker.update([e, ep_reward])
+                if self.evaluator is not None: self.evaluator.step(e, self.actor)
+
+                if e % verbose == 0: 
+                    tracker.save_metrics()
+                    self.buffer.flush()
+
+                if self.print_episodes:
+                    print(f'Ep: {e}, Env: {i}, Ep_Rew: {ep_reward}, Mean_Rew: {np.mean(mean_reward)}')
+                    print('alpha: {}    std: {}'.format(alpha, std))
+
+                if std_scale:
+                    std = self.scale_value(std, std_scaling_type, std_decay, std_min, e, mean_reward)
+
+                if alpha_scale:
+                    alpha = self.scale_value(alpha, alpha_scaling_type, alpha_decay, alpha_min, e, mean_reward)
+
+                e += 1
+
+        # Flush the episodes not saved by the verbose check
+        tracker.save_metrics()
+        self.buffer.flush()
+
+    def train_concurrent(self, tracker, n_episodes, verbose, params, hyperp, prefetch=2, sync_every=1, 
+            max_collect_ahead=1000, max_learn_ahead=0):
+        """Main loop for the agent's training phase with a collector thread and a learner.
+        The collector (see collect) steps the env with the NumPy copy of the actor and fills the 
+        buffer, while the learner performs the updates on batches sampled ahead by a Prefetcher.
+        TF releases the GIL during the updates, so env steps and gradient steps overlap.
+        The learner keeps the update-to-data ratio of train (one update every update_every env
+        steps after the first 100), and the staleness is bounded by:
+        max_collect_ahead (env steps collected without their updates), max_learn_ahead (updates
+        performed before their env steps), sync_every (updates between two copies of the actor
+        for the collector) and prefetch (batches sampled before their update)
+
+        Args:
+            tracker (object): used to store and save the training stats
+            n_episodes (int): n° of episodes to perform
+            verbose (int): how frequent we save the training stats
+            params (dict): agent parameters (e.g., the critic's gamma)
+            hyperp (dict): algorithmic specific values (e.g., tau)
+            prefetch (int): batches sampled ahead of the learner
+            sync_every (int): learner updates between two copies of the actor weights
+            max_collect_ahead (int): env steps the collector can run ahead of the learner
+            max_learn_ahead (int): updates the learner can run ahead of the collector
+
+        Returns:
+            None
+        """
+
+        # The collector acts without TF, the learner refreshes its copy in learn
+        self.inference = 'numpy'
+        self.policy = NumpyPolicy(self.actor.get_weights(), self.env.action_space.high[0])
+        self.inference_refresh = sync_every
+
+        buffer_lock = threading.Lock()
+        pace = threading.Condition()
+        # Written by the collector (steps, std, alpha, done) and by the learner (updates, stop)
+        shared = {'steps': 0, 'updates': 0, 'std': hyperp['std'], 'alpha': params['alpha'], 
+            'done': False, 'stop': False, 'error': None}
+
+        collector = threading.Thread(
+            target=self.collect, 
+            args=(tracker, n_episodes, verbose, params, hyperp, buffer_lock, pace, shared, max_collect_ahead), 
+            daemon=True
+        )
+        collector.start()
+
+        prefetcher = None
+        last_steps = 0
+
+        try:
+            while True:
+                with pace:
+                    # After the last episode, the learner performs the pending updates and stops
+                    can_update = lambda: shared['steps'] >= 100 and shared['error'] is None and \
+                        shared['updates'] < self.due_updates(shared['steps']) + (0 if shared['done'] else max_learn_ahead)
+                    pace.wait_for(lambda: shared['done'] or can_update())
+                    if not can_update(): break
+                    steps, std, alpha = shared['steps'], shared['std'], shared['alpha']
+
+                if prefetcher is None:
+                    prefetcher = Prefetcher(lambda: self.sample_batch(params['buffer']['batch'], buffer_lock), prefetch)
+
+                losses = self.learn(prefetcher.get(), params['gamma'], std, alpha, hyperp['tau'], buffer_lock)
+
+                with pace:
+                    shared['updates'] += 1
+                    pace.notify_all()
+
+                tracker.log_step(steps, [steps, *losses, alpha, std])
+                self.profiler.step(steps, steps - last_steps, self.grad_steps, tracker, self.buffer)
+                last_steps = steps
+
+        finally:
+            # Release the collector if the learner fails
+            with pace:
+                shared['stop'] = True
+                pace.notify_all()
+            if prefetcher is not None: prefetcher.close()
+            collector.join()
+
+        if shared['error'] is not None: raise shared['error']
+
+    def collect(self, tracker, n_episodes, verbose, params, hyperp, buffer_lock, pace, shared, max_collect_ahead):
+        """Collector loop of train_concurrent: it performs the episodes as train, without the updates
+
+        Args:
+            tracker (object): used to store and save the training stats
+            n_episodes (int): n° of episodes to perform
+            verbose (int): how frequent we save the training stats
+            params (dict): agent parameters (e.g., the critic's gamma)
+            hyperp (dict): algorithmic specific values (e.g., tau)
+            buffer_lock (threading.Lock): held while writing the buffer
+            pace (threading.Condition): notified at each env step, and waited when too far ahead
+            shared (dict): counters and std/alpha shared with the learner
+            max_collect_ahead (int): env steps the collector can run ahead of the learner
+
+        Returns:
+            None
+        """
+
+        mean_reward = deque(maxlen=100)
+
+        std, std_scale = hyperp['std'], hyperp['std_scale']
+        std_decay, std_min = params['std_decay'], params['std_min']
+        alpha, alpha_scale = params['alpha'], params['alpha_scale']
+        alpha_min, alpha_decay = params['alpha_min'], params['alpha_decay']
+        alpha_scaling_type = params['alpha_scaling_type']
+        std_scaling_type = params['std_scaling_type']
+
+        # Updates that can be pending before the collector waits for the learner
+        max_pending = max_collect_ahead // self.update_every
+
+        try:
+            for e in range(n_episodes):
+                ep_reward = 0
+            
+                state = self.env.reset()
+
+                while True:
+                    t0 = self.profiler.tic()
+                    action = self.get_action(state, std)
+                    self.profiler.toc('get_action', t0)
+
+                    t0 = self.profiler.tic()
+                    obs_state, obs_reward, done, _ = self.env.step(action)
+                    self.profiler.toc('env_step', t0)
+
+                    t0 = self.profiler.tic()
+                    with buffer_lock:
+                        self.buffer.store(state, action, obs_reward, obs_state, 1 - int(done))
+                    self.profiler.toc('buffer_store', t0)
+
+                    ep_reward += obs_reward
+                    state = obs_state
+
+                    with pace:
+                        shared['steps'] += 1
+                        pace.notify_all()
+                        pace.wait_for(lambda: shared['stop'] or \
+                            self.due_updates(shared['steps']) - shared['updates'] <= max_pending)
+                        if shared['stop']: return
+
+                    if done: break
+
+                mean_reward.append(ep_reward)
+                tracker.update([e, ep_reward])
+                # The learner updates self.actor meanwhile, the NumpyPolicy copy is swapped whole
+                if self.evaluator is not None: self.evaluator.step(e, self.policy)
+
+                if e % verbose == 0: 
+                    tracker.save_metrics()
+                    with buffer_lock:
+                        self.buffer.flush()
+
+                if self.print_episodes:
+                    print(f'Ep: {e}, Ep_Rew: {ep_reward}, Mean_Rew: {np.mean(mean_reward)}')
+                    print('alpha: {}    std: {}'.format(alpha, std))
+
+                if std_scale:
+                    std = self.scale_value(std, std_scaling_type, std_decay, std_min, e, mean_reward)
+
+                if alpha_scale:
+                    alpha = self.scale_value(alpha, alpha_scaling_type, alpha_decay, alpha_min, e, mean_reward)
+
+                with pace:
+                    shared['std'], shared['alpha'] = std, alpha
+
+        except Exception as error:
+            # Raised again by the learner
+            shared['error'] = error
+
+        finally:
+            with pace:
+                shared['done'] = True
+                pace.notify_all()
+
+    def train_apex(self, tracker, env_fn, n_episodes, verbose, params, hyperp, seed=0, n_actors=2, broadcast_every=100):
+        """Main loop for the agent's training phase in Ape-X style: n_actors processes step their
+        own env with a NumPy copy of the actor and fill their shard of a SharedBuffer, while this
+        process (the learner) performs the updates and publishes the actor weights every 
+        broadcast_every updates. n_episodes counts the episodes terminated by any actor, and the
+        std (shared with the actors) and alpha scaling is applied after each of them
+
+        Args:
+            tracker (object): used to store and save the training stats
+            env_fn (function): builds the env of an actor, must be picklable (e.g., functools.partial(gym.make, name))
+            n_episodes (int): n° of episodes to perform
+            verbose (int): how frequent we save the training stats
+            params (dict): agent parameters (e.g., the critic's gamma)
+            hyperp (dict): algorithmic specific values (e.g., tau)
+            seed (int): base seed of the actors
+            n_actors (int): n° of actor processes
+            broadcast_every (int): updates between two publications of the actor weights
+
+        Returns:
+            None
+        """
+
+        assert not self.prioritized and not params['buffer']['shared_next'], \
+            'the Ape-X mode supports the uniform buffer without shared_next'
+
+        mean_reward = deque(maxlen=100)
+
+        tau = hyperp['tau']
+        std, std_scale = hyperp['std'], hyperp['std_scale']
+        std_decay, std_min = params['std_decay'], params['std_min']
+        alpha, alpha_scale = params['alpha'], params['alpha_scale']
+        alpha_min, alpha_decay = params['alpha_min'], params['alpha_decay']
+        alpha_scaling_type = params['alpha_scaling_type']
+        std_scaling_type = params['std_scaling_type']
+
+        # The actors write in the shared buffer, that replaces the local one
+        self.buffer = SharedBuffer(
+            params['buffer']['size'], 
+            self.env.observation_space.shape, 
+            self.env.action_space.shape,
+            n_shards=n_actors,
+            dtype=params['buffer']['dtype']
+        )
+        weights = SharedWeights([w.shape for w in self.actor.get_weights()])
+        weights.publish(self.actor.get_weights())
+        weights.std = std
+
+        # Spawn: the actors import only NumPy and the env, not TF
+        ctx = mp.get_context('spawn')
+        episodes = ctx.Queue()
+        actors = [ctx.Process(
+            target=run_actor,
+            args=(self.buffer, weights, env_fn, i, seed, self.env.action_space.high[0], episodes),
+            daemon=True
+        ) for i in range(n_actors)]
+        for a in actors: a.start()
+
+        e = 0
+        last_steps = 0
+
+        try:
+            while e < n_episodes:
+                # Episodes terminated by the actors since the last update
+                while e < n_episodes and not episodes.empty():
+                    shard, _, ep_reward = episodes.get()
+                    mean_reward.append(ep_reward)
+                    tracker.update([e, ep_reward])
+                    if self.evaluator is not None: self.evaluator.step(e, self.actor)
+
+                    if e % verbose == 0: tracker.save_metrics()
+
+                    if self.print_episodes:
+                        print(f'Ep: {e}, Actor: {shard}, Ep_Rew: {ep_reward}, Mean_Rew: {np.mean(mean_reward)}')
+                        print('alpha: {}    std: {}'.format(alpha, std))
+
+                    if std_scale:
+                        std = self.scale_value(std, std_scaling_type, std_decay, std_min, e, mean_reward)
+                        weights.std = std
+
+                    if alpha_scale:
+                        alpha = self.scale_value(alpha, alpha_scaling_type, alpha_decay, alpha_min, e, mean_reward)
+
+                    e += 1
+
+                if not all(a.is_alive() for a in actors):
+                    raise RuntimeError('an Ape-X actor terminated')
+
+                steps = self.buffer.n_stored
+                if steps < 100:
+                    time.sleep(.01)
+                    continue
+
+                losses = self.update(
+                    params['gamma'], 
+                    params['buffer']['batch'],
+                    std,
+                    alpha,
+                    tau
+                )
+                if self.n_updates % broadcast_every == 0:
+                    weights.publish(self.actor.get_weights())
+
+                tracker.log_step(steps, [steps, *losses, alpha, std])
+                self.profiler.step(steps, steps - last_steps, self.grad_steps, tracker, self.buffer)
+                last_steps = steps
+
+        finally:
+            weights.stop = True
+            # An actor exits only when its queued episodes are consumed
+            for a in actors:
+                while a.is_alive():
+                    while not episodes.empty(): episodes.get()
+                    a.join(timeout=.1)
+            self.buffer.close()
+            weights.close()
+
+        # Flush the episodes not saved by the verbose check
+        tracker.save_metrics()
+
+    def due_updates(self, steps):
+        """Return the n° of updates performed by train after the given env steps
+        """
+
+        if steps < 100: return 0
+        return steps // self.update_every - 99 // self.update_every
+
+    @staticmethod
+    def final_observation(infos, i):
+        """Get the last observation of the i-th env of a vector env, before its automatic reset
+
+        Args:
+            infos (tuple or dict): infos returned by the vector env step
+            i (int): index of the terminated env
+
+        Returns:
+            obs_state (np.array): terminal observation of the env
+        """
+
+        # Older gym returns a tuple of per-env dicts, newer gym a single dict of arrays
+        if isinstance(infos, dict):
+            return infos['final_observation'][i]
+        return infos[i]['terminal_observation']
+
+    @staticmethod
+    def scale_value(value, scaling_type, decay, v_min, e, mean_reward):
+        """Scale std or alpha at the end of an episode
+
+        Args:
+            value (float): current value
+            scaling_type (str): 'standard_time', 'sigmoid_reward' or 'tanh_time'
+            decay (float): decay factor for 'standard_time'
+            v_min (float): min value for 'standard_time'
+            e (int): current episode
+            mean_reward (deque): last episodes rewards
+
+        Returns:
+            value (float): scaled value
+        """
+
+        if scaling_type == 'standard_time':
+            value = max(v_min, value * decay)
+        elif scaling_type == 'sigmoid_reward':
+            value = 1/(np.exp(np.mean(mean_reward) / 200) + 1)
+        elif scaling_type == 'tanh_time':
+            value = .5 - np.tanh(e / 100 - 3) / 2
+        return value
 
@@ -0,0 +1,67 @@
+"""Benchmark for SAC.get_action
+
+This measures the latency of a single action selection for each actor inference mode
+(see 'inference' in the actor section of config.yml). Run it from the repo root:
+python -m benchmarks.get_action
+"""
+
+import argparse
+import copy
+import time
+
+import gym
+import numpy as np
+
+from agent import SAC
+from utils.config import load_config, seed_everything
+
+def build_parser(cfg):
+    """Build the command line parser, with the defaults of the config
+
+    Args:
+        cfg (dict): loaded config
+
+    Returns:
+        parser (ArgumentParser): the parser
+    """
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-env', type=str, help='Gym env', default=cfg['train']['name'])
+    parser.add_argument('-calls', type=int, help='Timed calls for each mode', default=5000)
+    return parser
+
+def time_get_action(agent, states, std=.5):
+    """Time agent.get_action over a set of states
+
+    Args:
+        agent (SAC): agent to benchmark
+        states (np.array): states to use
+        std (float): Gaussian distribution std for action selection
+
+    Returns:
+        latency (float): mean seconds for each call
+    """
+
+    # Warm up (tracing, allocations)
+    for s in states[:100]: agent.get_action(s, std)
+
+    start = time.perf_counter()
+    for s in states: agent.get_action(s, std)
+    return (time.perf_counter() - start) / len(states)
+
+if __name__ == "__main__":
+    cfg = load_config()
+    args = build_parser(cfg).parse_args()
+    seed_everything(cfg['setup']['seed'])
+
+    env = gym.make(args.env)
+    states = np.array([env.observation_space.sample() for _ in range(args.calls)], dtype=np.float32)
+
+    latencies = {}
+    for mode in ['keras', 'function', 'numpy']:
+        params = copy.deepcopy(cfg['agent'])
+        params['actor']['inference'] = mode
+        latencies[mode] = time_get_action(SAC(env, params), states)
+
+    for mode, latency in latencies.items():
+        print(f'{mode}: {latency * 1e6:.1f} us/call ({latencies["keras"] / latency:.1f}x)')
@@ -0,0 +1,117 @@
+"""Benchmark for the precision and XLA options
+
+This compares the 'precision', 'loss_scale' and 'jit_compile' options of the actor/critic
+(the XLA of the 'graph' mode is update.jit_compile) on the speed and accuracy of the training:
+- seconds for each update on a full batch (lower is better)
+- max abs difference of the critic values from a float32 copy with the same weights
+- mean return of the last episodes of a short training from the same seed
+Run it from the repo root (CPU only, bfloat16 is fast on CPUs with AVX512_BF16/AMX):
+python -m benchmarks.precision -h_size 256 -episodes 100
+"""
+
+import argparse
+import copy
+
+import numpy as np
+
+from agent import SAC
+from benchmarks.suite import NullTracker, fill, make_env, timeit
+from utils.config import load_config, seed_everything
+
+parser = argparse.ArgumentParser()
+parser.add_argument('-env', type=str, help='Gym env', default='LunarLanderContinuous-v2')
+parser.add_argument('-mode', type=str, help='Update mode', default='graph')
+parser.add_argument('-h_size', type=int, help='Hidden size of actor and critic', default=256)
+parser.add_argument('-episodes', type=int, help='Training episodes for the return (0 to skip)', default=100)
+parser.add_argument('-repeats', type=int, help='Timed updates', default=200)
+
+# (precision, loss_scale, jit_compile) of actor and critic
+variants = {
+    'float32': ('float32', False, False),
+    'float32/xla': ('float32', False, True),
+    'bfloat16': ('mixed_bfloat16', False, False),
+    'bfloat16/loss_scale': ('mixed_bfloat16', True, False),
+    'bfloat16/xla': ('mixed_bfloat16', False, True),
+}
+
+class ReturnTracker(NullTracker):
+    """
+    Tracker keeping only the episode returns
+    """
+
+    def __init__(self):
+        self.returns = []
+
+    def update(self, metrics):
+        self.returns.append(metrics[1])
+
+def variant_params(cfg, mode, h_size, precision, loss_scale, jit_compile):
+    """Return the agent params of the config with the given options
+    """
+
+    params = copy.deepcopy(cfg['agent'])
+    params['buffer']['storage'] = 'memory'
+    params['update']['mode'] = mode
+    params['update']['jit_compile'] = jit_compile
+    for net in ['actor', 'critic']:
+        params[net].update(h_size=h_size, precision=precision, loss_scale=loss_scale, jit_compile=jit_compile)
+    return params
+
+def critic_error(agent, env, params, states, actions):
+    """Return the max abs difference of the critic values from a float32 copy of the critics
+    """
+
+    reference = copy.deepcopy(params)
+    reference['critic']['precision'] = 'float32'
+    reference_agent = SAC(env, reference)
+    for critic, reference_critic in zip(agent.critics, reference_agent.critics):
+        reference_critic.set_weights(critic.get_weights())
+
+    values = agent.critic_values(states, actions).numpy()
+    return float(np.max(np.abs(values - reference_agent.critic_values(states, actions).numpy())))
+
+def bench_variant(cfg, args, precision, loss_scale, jit_compile):
+    """Time the update, measure the critic error and the final return of a variant
+
+    Returns:
+        results (dict): seconds per update, max abs critic error, mean return of the last 10 episodes
+    """
+
+    seed_everything(cfg['setup']['seed'])
+    env = make_env(args.env)
+    params = variant_params(cfg, args.mode, args.h_size, precision, loss_scale, jit_compile)
+
+    agent = SAC(env, params)
+    fill(agent.buffer, env, 10000)
+    update = timeit(
+        lambda: agent.update(params['gamma'], params['buffer']['batch'], .5, params['alpha'], params['tau']),
+        args.repeats
+    )
+
+    states, actions = agent.buffer.sample(params['buffer']['batch'])[:2]
+    error = critic_error(agent, env, params, states, actions)
+
+    ep_return = np.nan
+    if args.episodes > 0:
+        seed_everything(cfg['setup']['seed'])
+        env = make_env(args.env)
+        env.seed(cfg['setup']['seed'])
+        agent = SAC(env, params)
+        tracker = ReturnTracker()
+        hyperp = {'tau': params['tau'], 'std': params['std'], 'std_scale': params['std_scale']}
+        agent.train(tracker, n_episodes=args.episodes, verbose=args.episodes + 1, params=params, hyperp=hyperp)
+        ep_return = float(np.mean(tracker.returns[-10:]))
+
+    return {'update': update, 'critic_error': error, 'return': ep_return}
+
+if __name__ == "__main__":
+    args = parser.parse_args()
+    cfg = load_config()
+
+    results = {name: bench_variant(cfg, args, *variant) for name, variant in variants.items()}
+
+    base = results['float32']['update']
+    print(f'{args.env}, {args.mode} update, h_size {args.h_size}')
+    for name, r in results.items():
+        print(f"{name}: {r['update'] * 1e3:.2f} ms/update ({base / r['update']:.2f}x), "
+            f"critic error {r['critic_error']:.2e}, return {r['return']:.1f}")
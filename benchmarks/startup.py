@@ -0,0 +1,64 @@
+"""Benchmark for the cold start
+
+This measures the wall time of `python main.py -h`, of spawning a runner worker (a fresh
+interpreter importing runner and main, as the pool of runner.py does) and of the first
+import of the agent (TensorFlow). Run it from any folder:
+python -m benchmarks.startup
+"""
+
+import argparse
+import multiprocessing as mp
+import os
+import subprocess
+import sys
+import time
+
+root_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+parser = argparse.ArgumentParser()
+parser.add_argument('-repeats', type=int, help='Timed repeats for each benchmark', default=5)
+
+def ready():
+    """Worker task: import what a runner worker imports before the training
+    """
+
+    import main
+    import runner
+    return True
+
+def time_command(args, repeats):
+    """Return the best wall time of a command over repeats runs
+    """
+
+    times = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        subprocess.run([sys.executable, *args], cwd=root_dir, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, check=True)
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+def time_spawn(repeats):
+    """Return the best wall time to spawn a worker and get its first result
+    """
+
+    ctx = mp.get_context('spawn')
+    times = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        with ctx.Pool(1) as pool:
+            pool.apply(ready)
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+if __name__ == "__main__":
+    args = parser.parse_args()
+    sys.path.insert(0, root_dir)
+
+    results = {
+        'main.py -h': time_command(['main.py', '-h'], args.repeats),
+        'spawn worker': time_spawn(args.repeats),
+        'import agent': time_command(['-c', 'import agent'], args.repeats)
+    }
+
+    for name, value in results.items():
+        print(f'{name}: {value * 1e3:.0f} ms')
@@ -0,0 +1,235 @@
+"""Benchmark suite for the SAC hot paths
+
+This times (CPU, offline) the replay buffer store/sample, SAC.get_action, the update step
+for the network sizes of stored_results, polyak_update and the end-to-end env steps/sec.
+Every result is expressed in seconds per operation (lower is better), saved as json and
+compared with a stored baseline. Run it from the repo root:
+python -m benchmarks.suite -baseline benchmarks/baseline.json
+"""
+
+import argparse
+import copy
+import json
+import os
+import sys
+import time
+
+import gym
+import numpy as np
+import tensorflow as tf
+
+from agent import SAC
+from benchmarks.get_action import time_get_action
+from utils.config import load_config, seed_everything
+from utils.memorybuffer import Buffer
+
+parser = argparse.ArgumentParser()
+parser.add_argument('-only', type=str, nargs='+', help='Benchmarks to run',
+    default=['buffer', 'get_action', 'update', 'polyak', 'env_steps'])
+parser.add_argument('-out', type=str, help='Json with the results', default='bench_results.json')
+parser.add_argument('-baseline', type=str, help='Json baseline to compare with', default='benchmarks/baseline.json')
+parser.add_argument('-tolerance', type=float, help='Allowed slowdown (0.2 = 20%%)', default=0.2)
+parser.add_argument('-save_baseline', action='store_true', help='Store the results as the new baseline')
+parser.add_argument('-repeats', type=int, help='Timed repeats for each benchmark', default=200)
+
+envs = ['LunarLanderContinuous-v2', 'Pendulum-v1']
+capacities = [10000, 100000, 1000000]
+batch_sizes = [128, 512]
+# h_layers x h_size of stored_results
+network_sizes = [(2, 16), (2, 64)]
+
+class NullTracker:
+    """
+    Tracker without outputs, for the end-to-end benchmark
+    """
+
+    def update(self, metrics): pass
+    def save_metrics(self): pass
+    def log_step(self, step, metrics): pass
+    def save_profile(self, report): pass
+
+class StepCounter(gym.Wrapper):
+    """
+    Wrapper counting the env steps
+    """
+
+    steps = 0
+
+    def step(self, action):
+        self.steps += 1
+        return self.env.step(action)
+
+def make_env(name):
+    """Make a gym env, falling back to the older Pendulum version
+    """
+
+    try:
+        return gym.make(name)
+    except gym.error.Error:
+        return gym.make(name.replace('-v1', '-v0'))
+
+def timeit(fn, repeats):
+    """Return the mean seconds of fn() over repeats calls, after a warm up call
+    """
+
+    fn()
+    start = time.perf_counter()
+    for _ in range(repeats): fn()
+    return (time.perf_counter() - start) / repeats
+
+def agent_params(cfg, h_layers, h_size):
+    """Return the agent params of the config with the given actor/critic size
+    """
+
+    params = copy.deepcopy(cfg['agent'])
+    params['actor']['h_layers'], params['actor']['h_size'] = h_layers, h_size
+    params['critic']['h_layers'], params['critic']['h_size'] = h_layers, h_size
+    params['buffer']['storage'] = 'memory'
+    return params
+
+def fill(buffer, env, n):
+    """Store n random transitions in the buffer
+    """
+
+    for _ in range(n):
+        buffer.store(env.observation_space.sample(), env.action_space.sample(), 0., env.observation_space.sample(), 1)
+
+def bench_buffer(cfg, repeats):
+    """Time Buffer.store and Buffer.sample for each capacity and batch size
+    """
+
+    env = make_env(envs[0])
+    results = {}
+    for capacity in capacities:
+        buffer = Buffer(capacity, env.observation_space.shape, env.action_space.shape)
+        state, action = env.observation_space.sample(), env.action_space.sample()
+        results[f'buffer_store/{capacity}'] = timeit(lambda: buffer.store(state, action, 0., state, 1), repeats * 10)
+
+        # Sampling from a full buffer
+        buffer.states[:] = np.random.randn(*buffer.states.shape)
+        buffer.n_samples = capacity
+        for batch in batch_sizes:
+            results[f'buffer_sample/{capacity}/{batch}'] = timeit(lambda: buffer.sample(batch), repeats)
+    return results
+
+def bench_get_action(cfg, repeats):
+    """Time SAC.get_action for each network size and inference mode
+    """
+
+    env = make_env(envs[0])
+    states = np.array([env.observation_space.sample() for _ in range(repeats * 10)], dtype=np.float32)
+    results = {}
+    for h_layers, h_size in network_sizes:
+        for mode in ['keras', 'function', 'numpy']:
+            params = agent_params(cfg, h_layers, h_size)
+            params['actor']['inference'] = mode
+            results[f'get_action/{h_layers}x{h_size}/{mode}'] = time_get_action(SAC(env, params), states)
+    return results
+
+def bench_update(cfg, repeats):
+    """Time SAC.update (sample, gradient step, polyak) for each network size and update mode
+    """
+
+    env = make_env(envs[0])
+    results = {}
+    for h_layers, h_size in network_sizes:
+        for mode in ['eager', 'graph']:
+            params = agent_params(cfg, h_layers, h_size)
+            params['update']['mode'] = mode
+            agent = SAC(env, params)
+            fill(agent.buffer, env, 10000)
+            results[f'update/{h_layers}x{h_size}/{mode}'] = timeit(
+                lambda: agent.update(params['gamma'], params['buffer']['batch'], .5, params['alpha'], params['tau']),
+                repeats
+            )
+    return results
+
+def bench_polyak(cfg, repeats):
+    """Time the polyak_update of both target critics for each network size
+    """
+
+    env = make_env(envs[0])
+    results = {}
+    for h_layers, h_size in network_sizes:
+        agent = SAC(env, agent_params(cfg, h_layers, h_size))
+        tau = tf.constant(cfg['agent']['tau'], dtype=tf.float32)
+        results[f'polyak_update/{h_layers}x{h_size}'] = timeit(
+            lambda: agent.update_target_critics(tau),
+            repeats
+        )
+    return results
+
+def bench_env_steps(cfg, repeats):
+    """Time SAC.train for a few episodes, as seconds for each env step
+    """
+
+    results = {}
+    for name in envs:
+        env = StepCounter(make_env(name))
+        params = agent_params(cfg, *network_sizes[0])
+        agent = SAC(env, params)
+        hyperp = {'tau': params['tau'], 'std': params['std'], 'std_scale': params['std_scale']}
+
+        start = time.perf_counter()
+        agent.train(NullTracker(), n_episodes=3, verbose=1000, params=params, hyperp=hyperp)
+        results[f'env_step/{name}'] = (time.perf_counter() - start) / env.steps
+    return results
+
+benchmarks = {
+    'buffer': bench_buffer,
+    'get_action': bench_get_action,
+    'update': bench_update,
+    'polyak': bench_polyak,
+    'env_steps': bench_env_steps
+}
+
+def compare(results, baseline, tolerance):
+    """Print the results against the baseline
+
+    Args:
+        results (dict): seconds per op of the current run
+        baseline (dict): seconds per op of the baseline
+        tolerance (float): allowed slowdown
+
+    Returns:
+        regressions (list): names of the benchmarks slower than the tolerance
+    """
+
+    regressions = []
+    for name, value in results.items():
+        if name not in baseline:
+            print(f'{name}: {value * 1e6:.1f} us (no baseline)')
+            continue
+
+        ratio = value / baseline[name]
+        status = 'REGRESSION' if ratio > 1 + tolerance else 'ok'
+        if status == 'REGRESSION': regressions.append(name)
+        print(f'{name}: {value * 1e6:.1f} us ({ratio:.2f}x baseline) {status}')
+    return regressions
+
+if __name__ == "__main__":
+    args = parser.parse_args()
+    cfg = load_config()
+    seed_everything(cfg['setup']['seed'])
+
+    results = {}
+    for name in args.only:
+        results.update(benchmarks[name](cfg, args.repeats))
+
+    with open(args.out, 'w') as f:
+        json.dump(results, f, indent=2)
+
+    baseline = {}
+    if os.path.exists(args.baseline):
+        with open(args.baseline, 'r') as f:
+            baseline = json.load(f)
+
+    regressions = compare(results, baseline, args.tolerance)
+
+    if args.save_baseline:
+        with open(args.baseline, 'w') as f:
+            json.dump({**baseline, **results}, f, indent=2)
+
+    if regressions:
+        print(f'{len(regressions)} regressions over {args.tolerance:.0%}')
+        sys.exit(1)
@@ -0,0 +1,84 @@
+"""Evaluation file for the continuous SAC algorithm
+
+This loads the actor weights of saved .h5 models (e.g., the best snapshots saved during the
+training in results/models/) and reports the mean/std return of the deterministic actor mean,
+running the episodes in parallel vector envs with one batched forward pass for each tick.
+The actor architecture is the one of the given config (e.g., the config.yml of a testN folder)
+"""
+
+import argparse
+import os
+import sys
+
+from main import config_path
+from utils.config import default_config_path, load_config, seed_everything
+
+def build_parser(cfg):
+    """Build the command line parser, with the defaults of the config
+
+    Args:
+        cfg (dict): loaded config
+
+    Returns:
+        parser (ArgumentParser): the parser
+    """
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-models', type=str, nargs='+', help='.h5 models to evaluate', required=True)
+    parser.add_argument('-config', type=str, help='Config of the models', default=default_config_path)
+    parser.add_argument('-env', type=str, help='Gym env', default=cfg['train']['name'])
+    parser.add_argument('-episodes', type=int, help='Episodes for each model', default=100)
+    parser.add_argument('-n_envs', type=int, help='N° of vectorized envs', default=cfg['train']['eval']['n_envs'])
+    return parser
+
+def main(cfg, argv=None):
+    """Evaluate the models
+
+    Args:
+        cfg (dict): loaded config
+        argv (list): command line arguments (sys.argv[1:] if None)
+
+    Returns:
+        results (dict): mean and std return of each model
+    """
+
+    config = vars(build_parser(cfg).parse_args(argv))
+    seed = cfg['setup']['seed']
+
+    if not cfg['setup']['use_gpu']:
+        os.environ['CUDA_VISIBLE_DEVICES'] = '-1'
+
+    import gym
+    import numpy as np
+    from utils.deepnetwork import DeepNetwork
+    from utils.evaluator import evaluate_policy
+    from utils.policy import NumpyPolicy
+
+    seed_everything(seed)
+
+    env = gym.make(config['env'])
+    envs = gym.vector.make(
+        config['env'],
+        num_envs=config['n_envs'],
+        asynchronous=cfg['train']['vector_mode'] == 'async'
+    )
+
+    # Weights only, so the Lambda output layer is rebuilt from the config
+    actor = DeepNetwork.build(env, {**cfg['agent']['actor'], 'print_model': False}, actor=True, name='actor')
+
+    results = {}
+    for path in config['models']:
+        actor.load_weights(path)
+        policy = NumpyPolicy(actor.get_weights(), env.action_space.high[0])
+
+        # Same episodes for each model
+        envs.seed(seed)
+        returns = evaluate_policy(policy, envs, config['episodes'])
+        results[path] = (float(np.mean(returns)), float(np.std(returns)))
+        print(f'{os.path.basename(path)}: Mean_Return: {results[path][0]}, Std_Return: {results[path][1]}')
+
+    envs.close()
+    return results
+
+if __name__ == "__main__":
+    main(load_config(config_path(sys.argv[1:])))
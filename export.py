@@ -0,0 +1,78 @@
+"""Export file for the continuous SAC algorithm
+
+This converts the actor of saved .h5 models (e.g., results/models/) in the NumPy format of
+utils/policy.py (a .npz with the weights and a .json with the architecture), that can be
+served with NumpyPolicy.load without TensorFlow. Each export is checked against the Keras
+outputs on random states. The actor architecture is the one of the given config
+"""
+
+import argparse
+import os
+import sys
+
+from main import config_path
+from utils.config import default_config_path, load_config
+
+def build_parser(cfg):
+    """Build the command line parser, with the defaults of the config
+
+    Args:
+        cfg (dict): loaded config
+
+    Returns:
+        parser (ArgumentParser): the parser
+    """
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-models', type=str, nargs='+', help='.h5 models to export', required=True)
+    parser.add_argument('-config', type=str, help='Config of the models', default=default_config_path)
+    parser.add_argument('-env', type=str, help='Gym env', default=cfg['train']['name'])
+    parser.add_argument('-tolerance', type=float, help='Max abs difference from Keras', default=1e-5)
+    return parser
+
+def main(cfg, argv=None):
+    """Export the models next to them (same path, without .h5)
+
+    Args:
+        cfg (dict): loaded config
+        argv (list): command line arguments (sys.argv[1:] if None)
+
+    Returns:
+        exports (list): paths of the exports, without extension
+    """
+
+    config = vars(build_parser(cfg).parse_args(argv))
+
+    if not cfg['setup']['use_gpu']:
+        os.environ['CUDA_VISIBLE_DEVICES'] = '-1'
+
+    import gym
+    import numpy as np
+    from utils.deepnetwork import DeepNetwork
+    from utils.policy import NumpyPolicy
+
+    env = gym.make(config['env'])
+    states = np.array([env.observation_space.sample() for _ in range(1000)], dtype=np.float32)
+
+    # Weights only, so the Lambda output layer is rebuilt from the config. The float32 weights
+    # are the same for any precision, and NumpyPolicy computes in float32 as the reference
+    actor = DeepNetwork.build(env, {**cfg['agent']['actor'], 'print_model': False, 'precision': 'float32'}, actor=True, name='actor')
+
+    exports = []
+    for path in config['models']:
+        actor.load_weights(path)
+        export = os.path.splitext(path)[0]
+        NumpyPolicy(actor.get_weights(), env.action_space.high[0]).save(export)
+
+        # Check the reloaded export, batched and on a single state
+        policy = NumpyPolicy.load(export)
+        error = np.max(np.abs(policy(states) - actor(states).numpy()))
+        error = max(error, np.max(np.abs(policy(states[0]) - actor(states[:1]).numpy()[0])))
+        assert error <= config['tolerance'], f'{path}: max abs error {error} over {config["tolerance"]}'
+
+        print(f'{export}.npz/.json: max abs error {error}')
+        exports.append(export)
+    return exports
+
+if __name__ == "__main__":
+    main(load_config(config_path(sys.argv[1:])))
@@ -1,115 +1,183 @@
 ''' This files considered results stored in a set of folders, each one containing
-one csv for each seed used '''
+one csv for each seed used, or the completed runs of the results index (-db, see utils/results.py)
+grouped by their label (the testN folder) or config hash.
+Each csv is parsed once and cached (keyed by path and mtime), runs of different lengths
+are padded with NaN and the graphs of each test are rendered in a process pool '''
+import argparse
 import os
-import csv
+import pickle
 import re
+from concurrent.futures import ProcessPoolExecutor
+from random import random
+
 import numpy as np
+import matplotlib
+matplotlib.use('Agg')
 from matplotlib import pyplot as plt
 
 stored_results_root = 'stored_results'
 graphs_dir = 'graphs'
+cache_path = graphs_dir + os.sep + '.results_cache.pkl'
+
+parser = argparse.ArgumentParser()
+parser.add_argument('-db', type=str, help='Results index to query instead of walking stored_results', default=None)
+
+
+def load_cache():
+    if not os.path.exists(cache_path): return dict()
+    with open(cache_path, 'rb') as file:
+        return pickle.load(file)
+
 
-# tot episodes -1
-n_episodes = 1000
-tests_dict = dict()
+def save_cache(cache):
+    with open(cache_path, 'wb') as file:
+        pickle.dump(cache, file)
 
-stored_res_iterator = os.walk(stored_results_root)
-# skip first level (test dir list)
-next(stored_res_iterator)
 
+def read_rewards(fp, cache):
+    mtime = os.path.getmtime(fp)
+    if fp in cache and cache[fp][0] == mtime:
+        return cache[fp][1]
 
-def extract_values_from_csvs(folder, filename_list):
-    seed_index = 0
+    # skip header and first episode, keep only results column
+    rewards = np.loadtxt(fp, delimiter=',', skiprows=2, usecols=1, ndmin=1)
+    cache[fp] = (mtime, rewards)
+    return rewards
 
+
+def extract_values_from_csvs(folder, filename_list, cache):
     # remove non csv files
     pattern = re.compile('.*\\.csv$')
-    filepath_list = [folder + os.sep + fn for fn in filename_list if bool(pattern.match(fn))]
-
-    # one file for each seed
-    values = np.zeros((len(filepath_list), n_episodes))
-    seed_values = list()
-
-    for fp in filepath_list:
-        with open(fp, 'r') as file:
-            file_reader = csv.reader(file)
-            # skip header
-            next(file_reader)
-            # skip first episode
-            next(file_reader)
-            # keep only results column
-            values[seed_index] = np.array(list(file_reader))[:, 1]
-            seed_values.append(fp.split('_')[-2])
-            seed_index += 1
-    return values, seed_values
-
-
-def plot_all_seeds(test_name, seed_list):
+    filepath_list = sorted(folder + os.sep + fn for fn in filename_list if bool(pattern.match(fn)))
+
+    series = [read_rewards(fp, cache) for fp in filepath_list]
+    seed_values = [fp.split('_')[-2] for fp in filepath_list]
+    return pad_series(series), seed_values
+
+
+def pad_series(series):
+    # one row for each seed, shorter runs padded with NaN
+    values = np.full((len(series), max(len(s) for s in series)), np.nan)
+    for seed_index, s in enumerate(series):
+        values[seed_index, :len(s)] = s
+    return values
+
+
+def extract_values_from_db(path):
+    from utils.results import ResultsDB
+    results = ResultsDB(path)
+
+    tests_dict, seeds_dict = dict(), dict()
+    runs = dict()
+    for run in results.runs():
+        runs.setdefault(run['label'] or run['config_id'], []).append(run)
+
+    for key, test_runs in runs.items():
+        test_runs = sorted(test_runs, key=lambda run: str(run['seed']))
+        # skip first episode, as for the csv
+        tests_dict[key] = pad_series([results.rewards(run['run_id'])[1:] for run in test_runs])
+        seeds_dict[key] = ['seed' + str(run['seed']) for run in test_runs]
+
+    results.close()
+    return tests_dict, seeds_dict
+
+
+def block_means(values, n_averaged_samples):
+    # mean of each block of n_averaged_samples episodes (last incomplete block dropped)
+    n_blocks = values.shape[-1] // n_averaged_samples
+    blocks = values[..., :n_blocks * n_averaged_samples]
+    blocks = blocks.reshape(*values.shape[:-1], n_blocks, n_averaged_samples)
+    # n_averaged_samples = 10 -> x: 5, 15, 25, ...
+    x = range(n_averaged_samples // 2, n_blocks * n_averaged_samples, n_averaged_samples)
+    return x, np.nanmean(blocks, axis=-1)
+
+
+def plot_all_seeds(test_name, values, seed_list):
     plt.close()
     n_averaged_samples = 20
-    values = tests_dict[test_name]
-    seed_index = 0
+    n_episodes = values.shape[1]
 
-    for episode_series in values:
-        averaged_episodes = np.mean(episode_series.reshape(-1, n_averaged_samples), axis=1)
-        # 1000 episodes, n_averaged_samples = 10 -> x: 5, 15, 25, ... 995
-        x = range(n_averaged_samples//2, n_episodes, n_averaged_samples)
-        plt.plot(x, averaged_episodes, 'o-', label=seed_list[seed_index])
-        seed_index += 1
+    x, averaged_episodes = block_means(values, n_averaged_samples)
+    for seed_index, episode_series in enumerate(averaged_episodes):
+        plt.plot(x, episode_series, 'o-', label=seed_list[seed_index])
 
     plt.title(test_name)
     plt.ylim([-500, 200])
-    plt.xlim([0, 1000])
+    plt.xlim([0, n_episodes])
     plt.legend()
     graph_path = graphs_dir + os.sep + 'tests_with_seeds' + os.sep + test_name + '.png'
     plt.savefig(graph_path, dpi=180)
     plt.cla()
 
-def plot_averaged_seeds(test_name):
+
+def plot_averaged_seeds(test_name, values):
     plt.close()
     n_averaged_samples = 20
-    values = tests_dict[test_name]
 
     # mean between seeds
-    values = np.mean(values, axis=0)
+    values = np.nanmean(values, axis=0)
     x1 = range(values.size)
     plt.plot(x1, values, '-')
 
-    averaged_episodes = np.mean(values.reshape(-1, n_averaged_samples), axis=1)
-    # 1000 episodes, n_averaged_samples = 10 -> x: 5, 15, 25, ... 995
-    x2 = range(n_averaged_samples // 2, n_episodes, n_averaged_samples)
+    x2, averaged_episodes = block_means(values, n_averaged_samples)
     plt.plot(x2, averaged_episodes, 'o-')
 
     plt.title(test_name)
     plt.ylim([-500, 200])
-    plt.xlim([0, 1000])
+    plt.xlim([0, values.size])
     graph_path = graphs_dir + os.sep + 'tests_with_variance' + os.sep + test_name + '.png'
     plt.savefig(graph_path, dpi=180)
     plt.cla()
 
-if __name__ == '__main__':
+
+def plot_test(test_name, values, seed_list):
+    plot_all_seeds(test_name, values, seed_list)
+    plot_averaged_seeds(test_name, values)
+
+
+def extract_values_from_dirs():
+    tests_dict = dict()
+    seeds_dict = dict()
+    cache = load_cache()
+
+    stored_res_iterator = os.walk(stored_results_root)
+    # skip first level (test dir list)
+    next(stored_res_iterator)
+
     for dir_info in stored_res_iterator:
         dir_path = dir_info[0]
         dir_files = dir_info[2]
         # for each test we add a 2D matrix containing results for each seed
         # using test folder name as key
         key = dir_path.split(sep=os.sep)[-1]
-        tests_dict[key], seed_values = extract_values_from_csvs(dir_path, dir_files)
-        plot_all_seeds(key, seed_values)
-        plot_averaged_seeds(key)
+        if not any(fn.endswith('.csv') for fn in dir_files): continue
+        tests_dict[key], seeds_dict[key] = extract_values_from_csvs(dir_path, dir_files, cache)
+
+    save_cache(cache)
+    return tests_dict, seeds_dict
 
-    from random import random
-    for key, values in tests_dict.items():
-        n_colors = len(tests_dict)
 
+if __name__ == '__main__':
+    args = parser.parse_args()
+
+    if args.db is not None:
+        tests_dict, seeds_dict = extract_values_from_db(args.db)
+    else:
+        tests_dict, seeds_dict = extract_values_from_dirs()
+
+    with ProcessPoolExecutor() as pool:
+        keys = list(tests_dict)
+        list(pool.map(plot_test, keys, [tests_dict[k] for k in keys], [seeds_dict[k] for k in keys]))
+
+    plt.close()
+    for key, values in tests_dict.items():
         n_averaged_samples = 100
-        values = np.mean(values, axis=0)
-        averaged_episodes = np.mean(values.reshape(-1, n_averaged_samples), axis=1)
-        # 1000 episodes, n_averaged_samples = 10 -> x: 5, 15, 25, ... 995
-        x = range(n_averaged_samples // 2, n_episodes, n_averaged_samples)
+        values = np.nanmean(values, axis=0)
+        x, averaged_episodes = block_means(values, n_averaged_samples)
 
         plt.plot(x, averaged_episodes, 'o-', label=key, color=(random(), random(), random()))
         plt.ylim([-300, 0])
-        plt.xlim([0, 1000])
-        plt.legend()
-        graph_path = graphs_dir + os.sep + 'all_tests' + '.png'
-        plt.savefig(graph_path, dpi=180)
\ No newline at end of file
+        plt.xlim([0, values.size])
+    plt.legend()
+    graph_path = graphs_dir + os.sep + 'all_tests' + '.png'
+    plt.savefig(graph_path, dpi=180)
@@ -4,58 +4,220 @@ This script instantiate the gym environment, the agent, and start the training
 """
 
 import argparse
+import copy
+import functools
 import os
+import sys
+import time
 
-import gym
-import yaml
+from utils.config import default_config_path, load_config, seed_everything
 
-from agent import SAC
-from utils.tracker import Tracker
+def build_parser(cfg):
+    """Build the command line parser, with the defaults of the config
 
-with open('config.yml', 'r') as ymlfile:
-    cfg = yaml.load(ymlfile, Loader=yaml.FullLoader)
+    Args:
+        cfg (dict): loaded config
+
+    Returns:
+        parser (ArgumentParser): the parser
+    """
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-config', type=str, help='Config file', default=default_config_path)
+    parser.add_argument('-env', type=str, help='Gym env', default=cfg['train']['name'])
+    parser.add_argument('-epochs', type=int, help='Epochs', default=cfg['train']['n_episodes'])
+    parser.add_argument('-n_envs', type=int, help='N° of vectorized envs', default=cfg['train']['n_envs'])
+    parser.add_argument('-verbose', type=int, help='Save stats freq', default=cfg['train']['verbose'])
+    parser.add_argument('-tau', type=float, help='Target net τ', default=cfg['agent']['tau'])
+    parser.add_argument('-std', type=float, help='σ for noise', default=cfg['agent']['std'])
+    parser.add_argument('-std_scale', type=float, help='σ scaling', default=cfg['agent']['std_scale'])
+    parser.add_argument('-force', action='store_true', help='Train even if the run is already in the results index')
+    return parser
+
+def resolve_config(cfg, config):
+    """Return the config with the command line overrides, that identifies the run in the results index
+
+    Args:
+        cfg (dict): loaded config
+        config (dict): parsed command line arguments
+
+    Returns:
+        resolved (dict): the config used by the run
+    """
+
+    resolved = copy.deepcopy(cfg)
+    resolved['train'].update(name=config['env'], n_episodes=config['epochs'], n_envs=config['n_envs'], verbose=config['verbose'])
+    resolved['agent'].update(tau=config['tau'], std=config['std'], std_scale=config['std_scale'])
+    return resolved
+
+def config_path(argv):
+    """Return the -config argument, before the full parsing (that needs the config defaults)
+    """
+
+    parser = argparse.ArgumentParser(add_help=False)
+    parser.add_argument('-config', type=str, default=default_config_path)
+    return parser.parse_known_args(argv)[0].config
+
+def main(cfg, argv=None, on_episode=None, label=None):
+    """Train the agent
+
+    Args:
+        cfg (dict): loaded config
+        argv (list): command line arguments (sys.argv[1:] if None)
+        on_episode (function): Tracker callback, that can stop the training (e.g., in sweep.py)
+        label (str): name of the run group in the results index (e.g., the testN folder of runner.py)
+
+    Returns:
+        save_tag (str): name of the Tracker files of the run (None if skipped, as already
+            completed in the results index)
+    """
+
+    config = vars(build_parser(cfg).parse_args(argv))
     seed = cfg['setup']['seed']
-    ymlfile.close()
 
-if not cfg['setup']['use_gpu']:
-    os.environ['CUDA_VISIBLE_DEVICES'] = '-1'
+    # Before importing TF, so that a skipped run costs nothing
+    results = None
+    if cfg['train']['results_db']:
+        from utils.results import ResultsDB, run_id
+        resolved = resolve_config(cfg, config)
+        results = ResultsDB(cfg['train']['results_db'])
+        if not config['force'] and results.completed(run_id(resolved, seed)):
+            print(f'Run {run_id(resolved, seed)} already completed, skipped')
+            results.close()
+            return None
 
-os.environ['PYTHONHASHSEED'] = str(seed)
+    # Before importing TF
+    if not cfg['setup']['use_gpu']:
+        os.environ['CUDA_VISIBLE_DEVICES'] = '-1'
 
-parser = argparse.ArgumentParser()
-parser.add_argument('-env', type=str, help='Gym env', default=cfg['train']['name'])
-parser.add_argument('-epochs', type=int, help='Epochs', default=cfg['train']['n_episodes'])
-parser.add_argument('-verbose', type=int, help='Save stats freq', default=cfg['train']['verbose'])
-parser.add_argument('-tau', type=float, help='Target net τ', default=cfg['agent']['tau'])
-parser.add_argument('-std', type=float, help='σ for noise', default=cfg['agent']['std'])
-parser.add_argument('-std_scale', type=float, help='σ scaling', default=cfg['agent']['std_scale'])
+    import gym
+    from agent import SAC
+    from utils.deepnetwork import DeepNetwork
+    from utils.evaluator import Evaluator
+    from utils.profiler import Profiler
+    from utils.tracker import StopTraining, Tracker
 
-def main(params):
-    config = vars(parser.parse_args())
+    seed_everything(seed)
 
     env = gym.make(config['env'])
     env.seed(seed)
     
-    agent = SAC(env, cfg['agent'])
     tag = 'SAC_Continuous'
 
-    # Initiate the tracker for stats
+    # The Tracker writer thread adds the episodes to the results index
+    on_save = None
+    if results is not None:
+        rid = results.start(resolved, seed, label)
+        on_save = functools.partial(results.add_episodes, rid)
+
+    # Initiate the tracker for stats, and the live telemetry stream if enabled
     tracker = Tracker(
         env.unwrapped.spec.id,
         tag,
         seed,
         cfg['agent'], 
-        ['Epoch', 'Ep_Reward']
+        ['Epoch', 'Ep_Reward'],
+        ['Step', 'Critic1_Loss', 'Critic2_Loss', 'Alpha', 'Std'],
+        cfg['train']['log'],
+        on_episode,
+        on_save=on_save,
+        telemetry=cfg['train']['telemetry'],
+        run_name=f'{label}/seed{seed}' if label else None
     )
 
-    # Train the agent
-    agent.train(
-        tracker,
-        n_episodes=config['epochs'], 
-        verbose=config['verbose'],
-        params=cfg['agent'],
-        hyperp=config
+    profiler = Profiler(**cfg['train']['profile'], trace_dir=tracker.profile_save)
+
+    # Evaluation of the actor mean in a worker process, the best snapshots saved as .h5
+    evaluator = None
+    if cfg['train']['eval']['every']:
+        evaluator = Evaluator(
+            functools.partial(gym.make, config['env']),
+            DeepNetwork.build(env, {**cfg['agent']['actor'], 'print_model': False}, actor=True, name='actor_eval'),
+            tracker,
+            env.action_space.high[0],
+            seed=seed,
+            **cfg['train']['eval']
+        )
+
+    agent = SAC(env, cfg['agent'], 
+        buffer_folder=tracker.buffer_save, 
+        n_envs=config['n_envs'], 
+        profiler=profiler,
+        evaluator=evaluator,
+        print_episodes=cfg['train']['telemetry']['print_episodes']
     )
+    print(f'Replay buffer: {agent.buffer.bytes_per_transition} bytes/transition')
+
+    # Train the agent
+    status = 'completed'
+    start = time.perf_counter()
+    try:
+        if config['n_envs'] > 1:
+            envs = gym.vector.make(
+                config['env'], 
+                num_envs=config['n_envs'], 
+                asynchronous=cfg['train']['vector_mode'] == 'async'
+            )
+            envs.seed(seed)
+
+            agent.train_vectorized(
+                tracker,
+                envs,
+                n_episodes=config['epochs'], 
+                verbose=config['verbose'],
+                params=cfg['agent'],
+                hyperp=config
+            )
+            envs.close()
+        elif cfg['train']['loop'] == 'concurrent':
+            agent.train_concurrent(
+                tracker,
+                n_episodes=config['epochs'], 
+                verbose=config['verbose'],
+                params=cfg['agent'],
+                hyperp=config,
+                **cfg['train']['concurrent']
+            )
+        elif cfg['train']['loop'] == 'apex':
+            agent.train_apex(
+                tracker,
+                functools.partial(gym.make, config['env']),
+                n_episodes=config['epochs'], 
+                verbose=config['verbose'],
+                params=cfg['agent'],
+                hyperp=config,
+                seed=seed,
+                **cfg['train']['apex']
+            )
+        else:
+            agent.train(
+                tracker,
+                n_episodes=config['epochs'], 
+                verbose=config['verbose'],
+                params=cfg['agent'],
+                hyperp=config
+            )
+    except StopTraining as stop:
+        print(f'Training {stop}')
+        status = 'stopped'
+    except BaseException:
+        if results is not None: results.finish(rid, 'failed', profiler.steps, time.perf_counter() - start)
+        raise
+
+    if evaluator is not None: evaluator.close()
+    # The samples after the last verbose episode (a no-op for the memory storage)
+    agent.buffer.flush()
+    try:
+        # Raises the error of the Tracker writer thread, if it failed on the last rows
+        tracker.close()
+    except BaseException:
+        if results is not None: results.finish(rid, 'failed', profiler.steps, time.perf_counter() - start)
+        raise
+
+    if results is not None:
+        results.finish(rid, status, profiler.steps, time.perf_counter() - start)
+        results.close()
+    return tracker.save_tag
 
 if __name__ == "__main__":
-    main(cfg)
+    main(load_config(config_path(sys.argv[1:])))
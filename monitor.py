@@ -0,0 +1,113 @@
+"""Telemetry monitor for the continuous SAC algorithm
+
+This listens on the Unix socket of the telemetry stream (train.telemetry.socket) and prints a
+table with the last record of each run every few seconds, so the runs of a host (e.g., the runner.py
+processes or the agents of population.py) can be watched in one place while training quietly.
+Start it before or after the runs: the runs never block nor fail while no monitor is listening
+python monitor.py -socket /tmp/sac_telemetry.sock -refresh 5
+"""
+
+import argparse
+import json
+import os
+import select
+import signal
+import socket
+import sys
+import time
+
+from main import config_path
+from utils.config import default_config_path, load_config
+
+columns = ['episode', 'steps', 'steps_per_sec', 'reward_mean', 'reward_last', 'Critic1_Loss', 'Critic2_Loss', 'Alpha', 'Std']
+
+def build_parser(cfg):
+    """Build the command line parser, with the defaults of the config
+
+    Args:
+        cfg (dict): loaded config
+
+    Returns:
+        parser (ArgumentParser): the parser
+    """
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-config', type=str, help='Config of the runs', default=default_config_path)
+    parser.add_argument('-socket', type=str, help='Unix socket of the telemetry stream',
+        default=cfg['train']['telemetry']['socket'] or '/tmp/sac_telemetry.sock')
+    parser.add_argument('-refresh', type=float, help='Seconds between two tables', default=5.)
+    parser.add_argument('-stale', type=float, help='Seconds without records before a run is dropped from the table', default=300.)
+    parser.add_argument('-out', type=str, help='Append the received records to this .jsonl file', default='')
+    return parser
+
+def format_table(runs):
+    """Return the table of the last record of each run
+
+    Args:
+        runs (dict): last record of each run
+
+    Returns:
+        table (str): one row for each run, sorted by name
+    """
+
+    width = max([len('run')] + [len(name) for name in runs])
+    rows = [f"{'run':<{width}} " + ' '.join(f'{c:>13}' for c in columns)]
+    for name in sorted(runs):
+        values = [runs[name].get(c) for c in columns]
+        rows.append(f'{name:<{width}} ' + ' '.join(
+            f'{"-":>13}' if v is None else f'{v:>13}' if isinstance(v, int) else f'{v:>13.4g}' for v in values
+        ))
+    return '\n'.join(rows)
+
+def monitor(path, refresh, stale, out=''):
+    """Receive the records until interrupted, printing the table of the runs every refresh seconds
+
+    Args:
+        path (str): Unix socket to bind
+        refresh (float): seconds between two tables
+        stale (float): seconds without records before a run is dropped
+        out (str): .jsonl file for the received records ('' for none)
+
+    Returns:
+        None
+    """
+
+    # A socket file left by a killed monitor
+    if os.path.exists(path): os.unlink(path)
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+    sock.bind(path)
+    out_file = open(out, 'a') if out else None
+    # Unlink the socket also when terminated (e.g., kill)
+    signal.signal(signal.SIGTERM, lambda *_: sys.exit(0))
+
+    runs, received = {}, {}
+    next_print = time.monotonic() + refresh
+    print(f'Listening on {path}')
+    try:
+        while True:
+            ready, _, _ = select.select([sock], [], [], max(next_print - time.monotonic(), 0))
+            if ready:
+                data = sock.recv(65536)
+                record = json.loads(data)
+                runs[record['run']] = record
+                received[record['run']] = time.monotonic()
+                if out_file is not None: out_file.write(data.decode() + '\n')
+
+            now = time.monotonic()
+            if now >= next_print:
+                for name in [name for name, t in received.items() if now - t > stale]:
+                    del runs[name], received[name]
+                if runs: print(time.strftime('%H:%M:%S') + '\n' + format_table(runs) + '\n', flush=True)
+                if out_file is not None: out_file.flush()
+                next_print = now + refresh
+    except KeyboardInterrupt:
+        pass
+    finally:
+        sock.close()
+        os.unlink(path)
+        if out_file is not None: out_file.close()
+
+if __name__ == "__main__":
+    args = build_parser(load_config(config_path(sys.argv[1:]))).parse_args()
+
+    monitor(args.socket, args.refresh, args.stale, args.out)
@@ -0,0 +1,138 @@
+"""Population launcher for the continuous SAC algorithm
+
+This trains the seeds of a list of configs (a grid of overrides of the per-agent hyperparameters,
+as runner.py) as a single population of agents in one process (see utils/population.py), instead
+of one process for each run. Each agent writes its own Tracker outputs, then its csv is moved in
+the stored_results/testN folder of its config, together with the config.yml, as runner.py.
+The config + seed runs already completed in the results index are skipped, the others recorded in it
+(with their own hash: a population trains differently from main.py, see population_config)
+"""
+
+import argparse
+import functools
+import glob
+import os
+import shutil
+import tempfile
+import time
+
+import yaml
+
+from runner import completed_runs, expand_grid, next_test_dirs
+from utils.config import default_config_path, load_config, seed_everything
+
+parser = argparse.ArgumentParser()
+parser.add_argument('-config', type=str, help='Base config', default=default_config_path)
+parser.add_argument('-seeds', type=int, nargs='+', help='Seeds for each config', default=[3, 9, 25])
+parser.add_argument('-grid', type=str, action='append', default=[],
+    help='Override of a per-agent hyperparameter as agent.key=v1,v2 (e.g., agent.tau=0.005,0.0005), repeat for a grid')
+parser.add_argument('-results', type=str, help='Results root', default='stored_results')
+
+def population_config(cfg):
+    """Return the config that identifies a population run in the results index. The population
+    always trains stacked fused critics in a single graph step (ignoring update.mode, critic.fused
+    and actor.inference), so its runs must not share the hash of the main.py runs of the same config
+    """
+    return {**cfg, 'launcher': 'population'}
+
+def main(cfg, seeds, grid, results_root):
+    """Train the population of the configs x seeds and store the csv of each agent
+
+    Args:
+        cfg (dict): base config
+        seeds (list): seeds for each config
+        grid (list): overrides as 'agent.key=v1,v2' of the per-agent hyperparameters
+        results_root (str): stored results root
+
+    Returns:
+        stored (list): paths of the stored csv
+    """
+
+    # Before importing TF
+    if not cfg['setup']['use_gpu']:
+        os.environ['CUDA_VISIBLE_DEVICES'] = '-1'
+
+    import gym
+    from utils.population import Population, member_keys
+    from utils.tracker import Tracker
+
+    # The networks, buffer and update sections are shared by the stacked agents
+    for g in grid:
+        key = g.split('=', 1)[0]
+        assert key.startswith('agent.') and key[6:] in member_keys, f'{key} is not a per-agent hyperparameter'
+
+    # As runner.py, the configs with all the seeds already completed do not get a testN folder
+    configs = []
+    for c in expand_grid(cfg, grid):
+        completed = completed_runs(population_config(c), seeds)
+        if len(completed) < len(seeds): configs.append((c, [seed for seed in seeds if seed not in completed]))
+        if completed: print(f'Skipped: seeds {completed} already completed')
+    if not configs: return []
+
+    test_dirs = next_test_dirs(os.path.abspath(results_root), len(configs))
+    for (c, _), test_dir in zip(configs, test_dirs):
+        with open(os.path.join(test_dir, 'config.yml'), 'w') as f:
+            yaml.dump(c, f, sort_keys=False)
+
+    seed_everything(cfg['setup']['seed'])
+
+    results = None
+    if cfg['train']['results_db']:
+        from utils.results import ResultsDB
+        results = ResultsDB(cfg['train']['results_db'])
+
+    # The Trackers write in a temporary folder, one for each agent
+    run_dir = tempfile.mkdtemp(prefix='sac_population_')
+    members = [(c, seed, test_dir) for (c, member_seeds), test_dir in zip(configs, test_dirs) for seed in member_seeds]
+
+    envs, trackers, run_ids = [], [], []
+    for i, (c, seed, test_dir) in enumerate(members):
+        env = gym.make(cfg['train']['name'])
+        env.seed(seed)
+        envs.append(env)
+
+        # The Tracker writer thread adds the episodes to the results index
+        on_save = None
+        if results is not None:
+            run_cfg = population_config({**c, 'setup': {**c['setup'], 'seed': seed}})
+            run_ids.append(results.start(run_cfg, seed, os.path.basename(test_dir)))
+            on_save = functools.partial(results.add_episodes, run_ids[-1])
+
+        trackers.append(Tracker(
+            env.unwrapped.spec.id,
+            'SAC_Continuous',
+            seed,
+            c['agent'],
+            ['Epoch', 'Ep_Reward'],
+            ['Step', 'Critic1_Loss', 'Critic2_Loss', 'Alpha', 'Std'],
+            cfg['train']['log'],
+            folder=os.path.join(run_dir, 'agent' + str(i), ''),
+            on_save=on_save,
+            telemetry=cfg['train']['telemetry'],
+            run_name=f'{os.path.basename(test_dir)}/seed{seed}/agent{i}'
+        ))
+
+    population = Population(envs, cfg['agent'], [c['agent'] for c, _, _ in members], [seed for _, seed, _ in members],
+        print_episodes=cfg['train']['telemetry']['print_episodes'])
+    start = time.perf_counter()
+    population.train(trackers, cfg['train']['n_episodes'], cfg['train']['verbose'], cfg['agent'])
+    duration = time.perf_counter() - start
+
+    stored = []
+    for i, (tracker, (_, _, test_dir)) in enumerate(zip(trackers, members)):
+        tracker.close()
+        # The agents step together, so each one performed all the steps in the whole duration
+        if results is not None: results.finish(run_ids[i], 'completed', population.steps, duration)
+        # The csv, together with the per-step shards if any
+        for fp in glob.glob(tracker.metric_save + '*'):
+            path = shutil.move(fp, os.path.join(test_dir, os.path.basename(fp)))
+            if os.path.basename(fp) == tracker.save_tag + '.csv': stored.append(path)
+    shutil.rmtree(run_dir)
+    if results is not None: results.close()
+    return stored
+
+if __name__ == "__main__":
+    args = parser.parse_args()
+
+    for stored in main(load_config(args.config), args.seeds, args.grid, args.results):
+        print(f'Stored: {stored}')
@@ -0,0 +1,235 @@
+"""Parallel launcher for the continuous SAC algorithm
+
+This script runs main.py for a list of seeds (and optionally a grid of config overrides)
+in a process pool. Each run gets the config object and its own working directory (for the
+results folder of the Tracker), then its csv is moved in a stored_results/testN folder (one for each configuration),
+together with the config.yml, as expected by generate_graphs.py. The config + seed runs already completed
+in the results index (see utils/results.py) are skipped
+"""
+
+import argparse
+import copy
+import glob
+import itertools
+import multiprocessing as mp
+import os
+import shutil
+import sys
+import tempfile
+
+import yaml
+
+from utils.config import default_config_path, load_config
+
+root_dir = os.path.dirname(os.path.abspath(__file__))
+
+# Set by init_worker in each pool process
+worker_slot = None
+worker_slots = None
+
+parser = argparse.ArgumentParser()
+parser.add_argument('-config', type=str, help='Base config', default=default_config_path)
+parser.add_argument('-seeds', type=int, nargs='+', help='Seeds for each config', default=[3, 9, 25])
+parser.add_argument('-grid', type=str, action='append', default=[],
+    help='Override as section.key=v1,v2 (e.g., agent.tau=0.005,0.0005), repeat for a grid')
+parser.add_argument('-workers', type=int, help='N° of parallel runs', default=os.cpu_count())
+parser.add_argument('-threads', type=int, help='CPU threads for each run', default=1)
+parser.add_argument('-results', type=str, help='Results root', default='stored_results')
+
+def set_key(cfg, key, value):
+    """Set a nested config value given its dotted key
+
+    Args:
+        cfg (dict): config to modify
+        key (str): dotted key (e.g., agent.actor.h_size)
+        value: new value
+
+    Returns:
+        None
+    """
+
+    *sections, last = key.split('.')
+    for s in sections: cfg = cfg[s]
+    assert last in cfg, f'Unknown config key {key}'
+    cfg[last] = value
+
+def expand_grid(cfg, grid):
+    """Build one config for each combination of the grid overrides
+
+    Args:
+        cfg (dict): base config
+        grid (list): overrides as 'section.key=v1,v2'
+
+    Returns:
+        configs (list): the configs to run
+    """
+
+    keys, values = [], []
+    for g in grid:
+        key, vals = g.split('=', 1)
+        keys.append(key)
+        values.append([yaml.safe_load(v) for v in vals.split(',')])
+
+    configs = []
+    for combination in itertools.product(*values):
+        c = copy.deepcopy(cfg)
+        for key, value in zip(keys, combination): set_key(c, key, value)
+        configs.append(c)
+    return configs
+
+def next_test_dirs(results_root, n):
+    """Create n new testN folders after the existing ones
+
+    Args:
+        results_root (str): stored results root
+        n (int): n° of folders
+
+    Returns:
+        dirs (list): paths of the new folders
+    """
+
+    ids = [int(d[4:]) for d in os.listdir(results_root) if d.startswith('test') and d[4:].isdigit()]
+    first = max(ids, default=0) + 1
+
+    dirs = []
+    for i in range(first, first + n):
+        path = os.path.join(results_root, 'test' + str(i))
+        os.makedirs(path)
+        dirs.append(path)
+    return dirs
+
+def init_worker(slots, threads):
+    """Pin the worker process to its own CPUs and limit the TF/BLAS threads
+
+    Args:
+        slots (Queue): free worker slots
+        threads (int): CPU threads for the worker
+
+    Returns:
+        None
+    """
+
+    global worker_slot, worker_slots
+    worker_slots = slots
+    slot = worker_slot = slots.get()
+
+    for var in ['OMP_NUM_THREADS', 'MKL_NUM_THREADS', 'OPENBLAS_NUM_THREADS',
+            'TF_NUM_INTRAOP_THREADS', 'TF_NUM_INTEROP_THREADS']:
+        os.environ[var] = str(threads)
+
+    if hasattr(os, 'sched_setaffinity'):
+        cpus = sorted(os.sched_getaffinity(0))
+        start = (slot * threads) % len(cpus)
+        os.sched_setaffinity(0, cpus[start:start + threads] or cpus)
+
+def run(cfg, seed, test_dir, on_episode=None):
+    """Run main.py with the given config and seed, then move its csv (with the memmap buffers and the
+    models) in test_dir
+
+    Args:
+        cfg (dict): config of the run
+        seed (int): seed of the run
+        test_dir (str): testN folder of the config
+        on_episode (function): Tracker callback, that can stop the run (see sweep.py)
+
+    Returns:
+        csv (str): path of the stored csv (None if skipped, see main.main)
+    """
+
+    cfg = copy.deepcopy(cfg)
+    cfg['setup']['seed'] = seed
+
+    # The Tracker writes in results/ of the working directory
+    run_dir = tempfile.mkdtemp(prefix='sac_seed' + str(seed) + '_')
+    os.chdir(run_dir)
+    sys.path.insert(0, root_dir)
+
+    try:
+        import main
+        save_tag = main.main(cfg, argv=[], on_episode=on_episode, label=os.path.basename(test_dir))
+    finally:
+        # Workers run a single task, the slot goes to the next one
+        if worker_slots is not None: worker_slots.put(worker_slot)
+
+    csv = None
+    # The csv, together with the per-step shards and the eval/profile/telemetry logs if any
+    for fp in glob.glob(os.path.join(run_dir, 'results', 'metrics', '*')):
+        stored = shutil.move(fp, os.path.join(test_dir, os.path.basename(fp)))
+        if save_tag and os.path.basename(fp) == save_tag + '.csv': csv = stored
+    # The memmap replay buffers, to reopen them with Buffer.load
+    store_folder(os.path.join(run_dir, 'results', 'buffers'), os.path.join(test_dir, 'buffers'))
+    # The best .h5 snapshots of the Evaluator
+    store_folder(os.path.join(run_dir, 'results', 'models'), os.path.join(test_dir, 'models'))
+    shutil.rmtree(run_dir)
+    return csv
+
+def store_folder(src, dst):
+    """Move the entries of a results folder in the same folder of test_dir, replacing
+    those of a previous run of the same seed
+
+    Args:
+        src (str): results folder of the run (e.g., results/buffers), skipped if missing
+        dst (str): folder in test_dir
+
+    Returns:
+        None
+    """
+
+    if not os.path.isdir(src): return
+
+    os.makedirs(dst, exist_ok=True)
+    for entry in os.listdir(src):
+        path = os.path.join(dst, entry)
+        if os.path.isdir(path): shutil.rmtree(path)
+        elif os.path.exists(path): os.remove(path)
+        shutil.move(os.path.join(src, entry), path)
+
+def completed_runs(cfg, seeds):
+    """Return the seeds of a config already completed in the results index
+
+    Args:
+        cfg (dict): config of the runs
+        seeds (list): seeds of the runs
+
+    Returns:
+        completed (list): the completed seeds
+    """
+
+    if not cfg['train']['results_db']: return []
+
+    from utils.results import ResultsDB, run_id
+    results = ResultsDB(cfg['train']['results_db'])
+    completed = [seed for seed in seeds if results.completed(run_id(cfg, seed))]
+    results.close()
+    return completed
+
+if __name__ == "__main__":
+    args = parser.parse_args()
+
+    cfg = load_config(args.config)
+
+    # The configs with all the seeds already completed do not get a testN folder
+    configs = []
+    for c in expand_grid(cfg, args.grid):
+        completed = completed_runs(c, args.seeds)
+        seeds = [seed for seed in args.seeds if seed not in completed]
+        if seeds: configs.append((c, seeds))
+        else: print('Skipped: config already completed for all the seeds')
+
+    results_root = os.path.abspath(args.results)
+    test_dirs = next_test_dirs(results_root, len(configs))
+
+    jobs = []
+    for (c, seeds), test_dir in zip(configs, test_dirs):
+        with open(os.path.join(test_dir, 'config.yml'), 'w') as f:
+            yaml.dump(c, f, sort_keys=False)
+        jobs += [(c, seed, test_dir) for seed in seeds]
+
+    # Spawn and a single task for each worker: each run imports TF (and builds its graphs) in a fresh interpreter
+    ctx = mp.get_context('spawn')
+    slots = ctx.Queue()
+    for i in range(args.workers): slots.put(i)
+
+    with ctx.Pool(args.workers, initializer=init_worker, initargs=(slots, args.threads), maxtasksperchild=1) as pool:
+        for stored in pool.starmap(run, jobs):
+            print(f'Stored: {stored}' if stored else 'Skipped: run already completed')
@@ -0,0 +1,177 @@
+"""Sweep scheduler for the continuous SAC algorithm
+
+This samples trials from a search space over the agent section of config.yml (see sweep.yml)
+and runs them in a process pool, as runner.py. The bad trials are stopped early with ASHA
+(asynchronous successive halving): when a trial reaches a rung (min_episodes * eta^k episodes)
+the mean of its last episode rewards is recorded, and it continues only if it is in the top 1/eta
+of the rewards recorded at that rung so far. Each trial is stored in a stored_results/testN folder
+with its config.yml and csv (shorter when stopped), together with a trial.json of its rungs
+"""
+
+import argparse
+import copy
+import json
+import multiprocessing as mp
+import os
+
+import numpy as np
+import yaml
+
+import runner
+from utils.config import default_config_path, load_config
+
+parser = argparse.ArgumentParser()
+parser.add_argument('-config', type=str, help='Base config', default=default_config_path)
+parser.add_argument('-space', type=str, help='Search space and ASHA params', default='sweep.yml')
+parser.add_argument('-trials', type=int, help='N° of sampled trials', default=27)
+parser.add_argument('-workers', type=int, help='N° of parallel trials', default=os.cpu_count())
+parser.add_argument('-threads', type=int, help='CPU threads for each trial', default=1)
+parser.add_argument('-results', type=str, help='Results root', default='stored_results')
+
+class Asha:
+    """
+    Class for the ASHA stopping rule, called by the Tracker of a trial after each episode
+    """
+
+    def __init__(self, rungs, records, lock, eta, window):
+        """Initialize the rule of a trial
+
+        Args:
+            rungs (list): episodes at which the trial is evaluated
+            records (dict): rewards recorded at each rung by all the trials (Manager dict)
+            lock (Lock): Manager lock of records
+            eta (int): reduction factor, the top 1/eta of each rung continues
+            window (int): last episodes averaged for the rung reward
+
+        Returns:
+            None
+        """
+
+        self.rungs = rungs
+        self.records = records
+        self.lock = lock
+        self.eta = eta
+        self.window = window
+
+        self.rewards = []
+        self.results = {}
+        self.stopped = False
+
+    def __call__(self, metrics):
+        """Record the episode reward and decide if the trial continues
+
+        Args:
+            metrics (list): episode and episode reward, as given to Tracker.update
+
+        Returns:
+            keep (bool): False to stop the trial
+        """
+
+        self.rewards.append(metrics[1])
+        n = len(self.rewards)
+        if n not in self.rungs: return True
+
+        reward = float(np.mean(self.rewards[-self.window:]))
+        self.results[n] = reward
+        with self.lock:
+            recorded = self.records.get(n, []) + [reward]
+            self.records[n] = recorded
+
+        # The first trials reaching a rung continue, as there is nothing to compare with
+        keep = len(recorded) < self.eta or reward >= np.quantile(recorded, 1 - 1 / self.eta)
+        self.stopped = not keep
+        return keep
+
+def sample_value(rng, spec):
+    """Sample a value of the search space
+
+    Args:
+        rng (np.random.Generator): random generator of the sweep
+        spec (list or dict): list of values, or low/high range (log-uniform with log: True)
+
+    Returns:
+        value: the sampled value (int if low and high are int)
+    """
+
+    if isinstance(spec, list): return spec[int(rng.integers(len(spec)))]
+
+    low, high = spec['low'], spec['high']
+    if spec.get('log', False):
+        value = float(np.exp(rng.uniform(np.log(low), np.log(high))))
+    else:
+        value = float(rng.uniform(low, high))
+    return int(round(value)) if isinstance(low, int) and isinstance(high, int) else value
+
+def build_rungs(min_episodes, max_episodes, eta):
+    """Return the rungs min_episodes * eta^k before max_episodes
+    """
+
+    rungs = []
+    while min_episodes < max_episodes:
+        rungs.append(min_episodes)
+        min_episodes *= eta
+    return rungs
+
+def run_trial(job):
+    """Run a trial with runner.run and store its trial.json
+
+    Args:
+        job (tuple): config, sampled values, testN folder and Asha rule of the trial
+
+    Returns:
+        test_dir (str): testN folder of the trial
+        results (dict): reward at each reached rung
+        stopped (bool): True if stopped by ASHA
+    """
+
+    cfg, values, test_dir, asha = job
+    runner.run(cfg, cfg['setup']['seed'], test_dir, on_episode=asha)
+
+    with open(os.path.join(test_dir, 'trial.json'), 'w') as f:
+        json.dump({'values': values, 'rungs': asha.results, 'stopped': asha.stopped}, f, indent=2)
+    return test_dir, asha.results, asha.stopped
+
+if __name__ == "__main__":
+    args = parser.parse_args()
+
+    cfg = load_config(args.config)
+    with open(args.space, 'r') as f:
+        sweep = yaml.safe_load(f)
+
+    assert all(key.startswith('agent.') for key in sweep['space']), 'the search space is over the agent section'
+
+    rng = np.random.default_rng(cfg['setup']['seed'])
+    trials = [{key: sample_value(rng, spec) for key, spec in sweep['space'].items()} for _ in range(args.trials)]
+    rungs = build_rungs(sweep['asha']['min_episodes'], cfg['train']['n_episodes'], sweep['asha']['eta'])
+
+    results_root = os.path.abspath(args.results)
+    test_dirs = runner.next_test_dirs(results_root, len(trials))
+
+    ctx = mp.get_context('spawn')
+    manager = ctx.Manager()
+    records, lock = manager.dict(), manager.Lock()
+
+    jobs = []
+    for values, test_dir in zip(trials, test_dirs):
+        c = copy.deepcopy(cfg)
+        for key, value in values.items(): runner.set_key(c, key, value)
+        with open(os.path.join(test_dir, 'config.yml'), 'w') as f:
+            yaml.dump(c, f, sort_keys=False)
+
+        asha = Asha(rungs, records, lock, sweep['asha']['eta'], sweep['asha']['window'])
+        jobs.append((c, values, test_dir, asha))
+
+    # As runner.py: spawn, one trial for each worker, pinned CPUs
+    slots = ctx.Queue()
+    for i in range(args.workers): slots.put(i)
+
+    summary = []
+    with ctx.Pool(args.workers, initializer=runner.init_worker, initargs=(slots, args.threads), maxtasksperchild=1) as pool:
+        for test_dir, results, stopped in pool.imap_unordered(run_trial, jobs):
+            status = f'stopped at {max(results)}' if stopped else 'completed'
+            print(f'{os.path.basename(test_dir)} {status}: {results}')
+            summary.append((len(results), results[max(results)] if results else -np.inf, test_dir))
+
+    print('Best trials:')
+    for _, reward, test_dir in sorted(summary, reverse=True)[:5]:
+        print(f'{os.path.basename(test_dir)}: {reward}')
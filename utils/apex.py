@@ -0,0 +1,304 @@
+"""Ape-X script
+
+This manages the shared memory of the Ape-X mode (see SAC.train_apex) and its actor processes.
+The replay buffer lives in multiprocessing.shared_memory blocks and is split in one shard for
+each actor: every shard has a single writer, so the insertion is lock-free. The learner
+publishes the actor weights in another block, with a version counter incremented before and
+after each write (a seqlock), that the actors poll at every step.
+The learner can sample a slot while its actor overwrites it: as with the other off-policy
+approximations of the buffer, the sample is used anyway.
+"""
+
+import secrets
+from multiprocessing import shared_memory
+
+import numpy as np
+
+from utils.memorybuffer import Buffer
+from utils.policy import NumpyPolicy
+
+class SharedBuffer(Buffer):
+    """
+    Class for the sharded Buffer in shared memory
+    """
+
+    def __init__(self, size, state_shape, action_shape, n_shards=1, dtype='float32', prefix=None):
+        """Create the shared memory blocks of the fields, or attach to the existing ones
+
+        Args:
+            size (int): maxsize of the buffer (split in n_shards equal shards)
+            state_shape (tuple): shape of a single state
+            action_shape (tuple): shape of a single action
+            n_shards (int): n° of shards (one for each writer process)
+            dtype (str): storage type of states and actions ('float32' or 'float16')
+            prefix (str): name prefix of the blocks to attach (None creates new blocks)
+
+        Returns:
+            None
+        """
+
+        self.owner = prefix is None
+        self.prefix = prefix or 'sac_' + secrets.token_hex(4)
+        self.blocks = []
+        self.n_shards = n_shards
+        self.shard_size = size // n_shards
+
+        super().__init__(self.shard_size * n_shards, state_shape, action_shape, dtype=dtype)
+
+        # For each shard: next slot to write, n° of valid samples, n° of stored samples
+        self.counters = self.allocate('counters', (n_shards, 3), np.int64)
+
+    def __reduce__(self):
+        """Pickle the buffer as its blocks names, so that a process attaches to them
+        """
+        return (SharedBuffer, (self.max_size, self.state_shape, self.action_shape, self.n_shards, self.dtype, self.prefix))
+
+    def allocate(self, name, shape, dtype):
+        """Create (or attach to) the shared memory block of a field
+
+        Args:
+            name (str): field name, appended to the prefix
+            shape (tuple): array shape
+            dtype (np.dtype): array type
+
+        Returns:
+            array (np.array): the array on the block (zero initialized when created)
+        """
+
+        nbytes = max(int(np.prod(shape)) * np.dtype(dtype).itemsize, 1)
+        block = shared_memory.SharedMemory(name=self.prefix + '_' + name, create=self.owner, size=nbytes)
+        self.blocks.append(block)
+        return np.ndarray(shape, dtype=dtype, buffer=block.buf)
+
+    def store(self, state, action, reward, obs_state, done, shard=0):
+        """Write the sample in the next slot of the shard, overwriting its oldest one when full.
+        Only the process owning the shard writes in it
+
+        Args:
+            state (list): state of the agent
+            action (list): performed action
+            reward (float): received reward
+            obs_state (list): observed state after the action
+            done (int): 1 if terminal states in the last episode
+            shard (int): shard of the writer
+
+        Returns:
+            None
+        """
+
+        ptr, n_samples, n_stored = self.counters[shard]
+        i = shard * self.shard_size + ptr
+
+        self.states[i] = state
+        self.actions[i] = action
+        self.rewards[i] = reward
+        self.obs_states[i] = obs_state
+        self.dones[i] = done
+
+        # The sample becomes visible to the learner only after it is written
+        self.counters[shard] = ((ptr + 1) % self.shard_size, min(n_samples + 1, self.shard_size), n_stored + 1)
+
+    def sample(self, batch_size):
+        """Get the samples from the buffer, uniformly over the valid samples of all the shards
+
+        Args:
+            batch_size (int): size of the batch to sample
+
+        Returns:
+            states (np.array): states of the last episode
+            actions (np.array): performed action in the last episode
+            rewards (np.array): received reward in the last episode
+            obs_states (np.array): observed state after the action in the last episode
+            dones (np.array): 1 if terminal states in the last episode
+        """
+
+        counts = self.counters[:, 1].copy()
+        ends = np.cumsum(counts)
+        draws = np.random.randint(0, ends[-1], size=batch_size)
+        shards = np.searchsorted(ends, draws, side='right')
+        idx = shards * self.shard_size + draws - (ends[shards] - counts[shards])
+        return self.gather(idx)
+
+    def clear(self):
+        """Clear all the shards
+        """
+        self.counters[:] = 0
+
+    def close(self):
+        """Detach from the blocks, and free them if this process created them
+        """
+
+        # The arrays reference the blocks memory
+        self.states = self.actions = self.rewards = self.obs_states = self.dones = self.counters = None
+        for block in self.blocks:
+            block.close()
+            if self.owner: block.unlink()
+        self.blocks = []
+
+    @property
+    def size(self):
+        """Return the n° of valid samples of all the shards
+        """
+        return int(self.counters[:, 1].sum())
+
+    @property
+    def n_stored(self):
+        """Return the n° of samples stored by all the shards (i.e., the env steps)
+        """
+        return int(self.counters[:, 2].sum())
+
+
+class SharedWeights:
+    """
+    Class for the actor weights broadcast by the learner to the actor processes
+    """
+
+    def __init__(self, shapes, prefix=None):
+        """Create the shared memory block of the weights, or attach to the existing one
+
+        Args:
+            shapes (list): shapes of the actor weights (as returned by model.get_weights())
+            prefix (str): name prefix of the block to attach (None creates a new block)
+
+        Returns:
+            None
+        """
+
+        self.shapes = [tuple(s) for s in shapes]
+        self.owner = prefix is None
+        self.prefix = prefix or 'sac_' + secrets.token_hex(4)
+
+        n_weights = sum(int(np.prod(s)) for s in self.shapes)
+        # Header: version (odd while writing), stop flag, std of the actors
+        self.block = shared_memory.SharedMemory(name=self.prefix + '_weights', create=self.owner, size=8 * 3 + 4 * n_weights)
+        self.header = np.ndarray((3,), dtype=np.float64, buffer=self.block.buf)
+        self.flat = np.ndarray((n_weights,), dtype=np.float32, buffer=self.block.buf, offset=8 * 3)
+
+    def __reduce__(self):
+        """Pickle the weights as their block name, so that a process attaches to it
+        """
+        return (SharedWeights, (self.shapes, self.prefix))
+
+    def publish(self, weights):
+        """Write new weights (learner side)
+
+        Args:
+            weights (list): actor weights as returned by model.get_weights()
+
+        Returns:
+            None
+        """
+
+        version = self.header[0]
+        self.header[0] = version + 1
+        self.flat[:] = np.concatenate([np.ravel(w) for w in weights])
+        self.header[0] = version + 2
+
+    def read(self, version=-1):
+        """Read the weights if newer than the given version (actor side)
+
+        Args:
+            version (float): version of the weights in use
+
+        Returns:
+            version (float): version of the returned weights (None if not newer)
+            weights (list): actor weights (None if not newer)
+        """
+
+        while True:
+            start = self.header[0]
+            if start == version: return None, None
+            if start % 2: continue
+
+            flat = self.flat.copy()
+            # Retry if a write started during the copy
+            if self.header[0] != start: continue
+
+            weights, offset = [], 0
+            for shape in self.shapes:
+                n = int(np.prod(shape))
+                weights.append(flat[offset:offset + n].reshape(shape))
+                offset += n
+            return start, weights
+
+    @property
+    def stop(self):
+        """Return True when the learner asks the actors to stop
+        """
+        return bool(self.header[1])
+
+    @stop.setter
+    def stop(self, value):
+        self.header[1] = float(value)
+
+    @property
+    def std(self):
+        """Return the Gaussian std of the actors exploration
+        """
+        return float(self.header[2])
+
+    @std.setter
+    def std(self, value):
+        self.header[2] = value
+
+    def close(self):
+        """Detach from the block, and free it if this process created it
+        """
+
+        self.header = self.flat = None
+        self.block.close()
+        if self.owner: self.block.unlink()
+
+
+def run_actor(buffer, weights, env_fn, shard, seed, action_range, episodes):
+    """Actor process: step its own env with a NumPy copy of the actor and fill its shard
+
+    Args:
+        buffer (SharedBuffer): shared replay buffer
+        weights (SharedWeights): actor weights published by the learner
+        env_fn (function): builds the env of the actor (e.g., functools.partial(gym.make, name))
+        shard (int): index of the actor and of its shard
+        seed (int): base seed (the actor uses seed + shard)
+        action_range (float): scale of the actor tanh output
+        episodes (Queue): receives (shard, env steps, episode reward) after each episode
+
+    Returns:
+        None
+    """
+
+    np.random.seed(seed + shard)
+    env = env_fn()
+    # Old gym API, as in main.py
+    if hasattr(env, 'seed'): env.seed(seed + shard)
+
+    version, w = weights.read()
+    policy = NumpyPolicy(w, action_range)
+
+    try:
+        while not weights.stop:
+            state = env.reset()
+            ep_reward = 0
+
+            while True:
+                new_version, w = weights.read(version)
+                if w is not None:
+                    version = new_version
+                    policy.set_weights(w)
+
+                std = weights.std
+                action = policy(np.asarray(state, dtype=np.float32)[None])[0]
+                action += std * np.random.standard_normal(action.shape)
+
+                obs_state, obs_reward, done, _ = env.step(action)
+                buffer.store(state, action, obs_reward, obs_state, 1 - int(done), shard=shard)
+
+                ep_reward += obs_reward
+                state = obs_state
+
+                if done or weights.stop: break
+
+            if done: episodes.put((shard, buffer.counters[shard, 2], ep_reward))
+
+    finally:
+        buffer.close()
+        weights.close()
@@ -0,0 +1,73 @@
+"""Config script
+
+This loads config.yml once and seeds the random generators, so that no module reads the
+config (or imports TensorFlow) at import time. The config is passed explicitly to main,
+SAC, DeepNetwork.build and Tracker. Another config file is merged over config.yml of the repo,
+so the configs stored before an option was added (e.g., stored_results/testN/config.yml) still load.
+"""
+
+import os
+import random
+import sys
+
+import numpy as np
+import yaml
+
+# config.yml next to the scripts, independently of the working directory
+default_config_path = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'config.yml')
+
+def load_config(path=None):
+    """Read the yaml config, with the defaults of config.yml of the repo for its missing keys
+
+    Args:
+        path (str): config file (config.yml of the repo if None)
+
+    Returns:
+        cfg (dict): the config, with setup, train and agent sections
+    """
+
+    with open(default_config_path, 'r') as ymlfile:
+        cfg = yaml.load(ymlfile, Loader=yaml.FullLoader)
+    if path is None or os.path.abspath(path) == default_config_path: return cfg
+
+    with open(path, 'r') as ymlfile:
+        return merge_config(cfg, yaml.load(ymlfile, Loader=yaml.FullLoader) or {})
+
+def merge_config(defaults, cfg):
+    """Merge a config over the defaults, section by section
+
+    Args:
+        defaults (dict): default config (e.g., config.yml of the repo)
+        cfg (dict): loaded config, whose values win
+
+    Returns:
+        merged (dict): the defaults updated with cfg, recursively
+    """
+
+    merged = dict(defaults)
+    for key, value in cfg.items():
+        if isinstance(value, dict) and isinstance(merged.get(key), dict):
+            merged[key] = merge_config(merged[key], value)
+        else:
+            merged[key] = value
+    return merged
+
+def seed_everything(seed):
+    """Seed python, numpy and (if already imported) TensorFlow
+
+    TensorFlow is seeded only if already imported, so that lightweight tools do not pay
+    its import cost: training code calls this after importing the agent
+
+    Args:
+        seed (int): seed of the run
+
+    Returns:
+        None
+    """
+
+    os.environ['PYTHONHASHSEED'] = str(seed)
+    random.seed(seed)
+    np.random.seed(seed)
+
+    tf = sys.modules.get('tensorflow')
+    if tf is not None: tf.random.set_seed(seed)
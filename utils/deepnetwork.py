@@ -1,21 +1,68 @@
 """DNN builder script
 
-This manages the DNN creation and printing for the agent
+This manages the DNN creation and printing for the agent.
+With 'fused' in the critic params, a single model computes an ensemble of n_critics critics:
+each layer is a StackedDense, with the weights of all the critics stacked in one tensor and
+computed with one batched matmul. With n_agents the actor and the critic of a population
+of agents are stacked in the same way (see population.py), on inputs with a leading agents axis.
+With a mixed 'precision' the hidden layers compute in bfloat16/float16 on float32 weights, while
+the output layers stay in float32; optimizer() adds the loss scaling and forward() the XLA compilation
 """
 
-import yaml
-
-with open('config.yml', 'r') as ymlfile:
-    cfg = yaml.load(ymlfile, Loader=yaml.FullLoader)
-    seed = cfg['setup']['seed']
-    ymlfile.close()
-
+import numpy as np
 import tensorflow as tf
 from tensorflow.keras import backend as K
-from tensorflow.keras.layers import Input, Dense, Lambda, Concatenate
+from tensorflow.keras.layers import Input, Dense, Lambda, Concatenate, Layer
+from tensorflow.keras.mixed_precision import LossScaleOptimizer
 from tensorflow.keras.models import Model
-from tensorflow.keras.utils import plot_model
-tf.random.set_seed(seed)
+from tensorflow.keras.optimizers import Adam
+
+precisions = ['float32', 'mixed_bfloat16', 'mixed_float16']
+
+class StackedDense(Layer):
+    """
+    Class for n independent Dense layers, applied to n stacked inputs with a single batched matmul
+    """
+
+    def __init__(self, n, units, activation=None, kernel_initializer=None, **kwargs):
+        """Initialize the layer
+
+        Args:
+            n (int): n° of stacked Dense layers
+            units (int): output size of each Dense layer
+            activation (str): activation of each Dense layer
+            kernel_initializer (Initializer): initializer of the kernels (Glorot uniform of each Dense if None)
+
+        Returns:
+            None
+        """
+
+        super().__init__(**kwargs)
+        self.n = n
+        self.units = units
+        self.activation = tf.keras.activations.get(activation)
+        self.kernel_initializer = kernel_initializer
+
+    def build(self, input_shape):
+        """Create the stacked kernels (n, input size, units) and biases (n, 1, units)
+        """
+
+        input_size = int(input_shape[-1])
+        # Glorot uniform of each (input size, units) kernel, as Dense
+        limit = np.sqrt(6 / (input_size + self.units))
+        self.kernel = self.add_weight(name='kernel', shape=(self.n, input_size, self.units),
+            initializer=self.kernel_initializer or tf.random_uniform_initializer(-limit, limit))
+        self.bias = self.add_weight(name='bias', shape=(self.n, 1, self.units), initializer='zeros')
+
+    def call(self, inputs):
+        """Compute the n layers on inputs with shape (n, batch, input size)
+        """
+        return self.activation(tf.matmul(inputs, self.kernel) + self.bias)
+
+    def get_config(self):
+        config = super().get_config()
+        config.update({'n': self.n, 'units': self.units, 'activation': tf.keras.activations.serialize(self.activation)})
+        return config
 
 class DeepNetwork:
     """
@@ -23,17 +70,21 @@ class DeepNetwork:
     """
 
     @staticmethod  
-    def build(env, params, actor=False, name='model'):
+    def build(env, params, actor=False, name='model', n_agents=None):
         """Gets the DNN architecture and build it
 
         Args:
             env (gym): the gym env to take agent I/O
-            params (dict): n° and size of hidden layers, print model for debug
+            params (dict): n° and size of hidden layers, print model for debug,
+                fused and n_critics for the critic ensemble, precision of the hidden layers
             actor (bool): wether to build the actor or the critic
             name (str): file name for the model
+            n_agents (int): n° of stacked agents, that take inputs with shape (n_agents, batch, size)
+                (even a single one, None for an agent without the agents axis)
 
         Returns:
-            model: the uncompiled DNN Model
+            model: the uncompiled DNN Model (the critic ensemble outputs (n_critics, batch, action size),
+                the stacked agents (n_agents, batch, action size) and (n_agents * n_critics, batch, action size))
         """
 
         input_size = env.observation_space.shape[0]
@@ -42,26 +93,48 @@ class DeepNetwork:
         # Some envs does not env symmetric bounds for the actions!
         action_range = env.action_space.high[0]
 
-        state_input = Input(shape=(input_size,), name='input_state_layer')
+        # Keras casts the inputs of each layer to its compute dtype, so only the outputs need float32
+        precision = params.get('precision', 'float32')
+        assert precision in precisions
+
+        # The critic ensemble repeats its inputs for each critic, the stacked agents already have their own inputs
+        fused = not actor and params.get('fused', False)
+        if n_agents is not None:
+            n_critics = 1 if actor else params['n_critics']
+            n = n_agents * n_critics
+            dense = lambda units, activation, name, dtype=precision, **kw: StackedDense(n, units, activation, name=name, dtype=dtype, **kw)
+            stack = lambda x, name: Lambda(lambda i: tf.repeat(i, n_critics, axis=0), name=name, dtype=precision)(x)
+        elif fused:
+            n = params['n_critics']
+            dense = lambda units, activation, name, dtype=precision, **kw: StackedDense(n, units, activation, name=name, dtype=dtype, **kw)
+            stack = lambda x, name: Lambda(lambda i: tf.repeat(i[None], n, axis=0), name=name, dtype=precision)(x)
+        else:
+            dense = lambda units, activation, name, dtype=precision, **kw: Dense(units, activation=activation, name=name, dtype=dtype, **kw)
+            stack = lambda x, name: x
+
+        # The stacked agents have an agents axis before the batch one
+        input_shape = (None, input_size) if n_agents is not None else (input_size,)
+        state_input = Input(shape=input_shape, name='input_state_layer')
         h_state = state_input
         
         if not actor:
+            h_state = stack(h_state, 'stack_state_layer')
             for i in range(params['h_state_layers']):
-                h_state = Dense(params['h_state_size'], activation='relu', name='hidden_state_' + str(i))(h_state)
+                h_state = dense(params['h_state_size'], 'relu', 'hidden_state_' + str(i))(h_state)
 
-            action_input = Input(shape=(action_size,), name='input_action_layer')
-            h_action = action_input
+            action_input = Input(shape=input_shape[:-1] + (action_size,), name='input_action_layer')
+            h_action = stack(action_input, 'stack_action_layer')
             for i in range(params['h_action_layers']):
-                h_action = Dense(params['h_action_size'], activation='relu', name='hidden_action_' + str(i))(h_action)
+                h_action = dense(params['h_action_size'], 'relu', 'hidden_action_' + str(i))(h_action)
 
-            h = Concatenate()([h_state, h_action])
+            h = Concatenate(dtype=precision)([h_state, h_action])
 
         h_size = params['h_size']
         h_layers = params['h_layers']
 
         if actor: h = h_state
         for i in range(h_layers):
-            h = Dense(h_size, activation='relu', name='hidden_' + str(i))(h)
+            h = dense(h_size, 'relu', 'hidden_' + str(i))(h)
 
         if actor:
             # Pendulum requires to explore its actions starting from low values
@@ -69,21 +142,56 @@ class DeepNetwork:
             if env.unwrapped.spec.id == 'Pendulum-v0':
                 k_init = tf.random_uniform_initializer(minval=-0.003, maxval=0.003)
             
-            y = Dense(action_size, activation='tanh', name='actor_output_layer', kernel_initializer=k_init)(h)
+            y = dense(action_size, 'tanh', 'actor_output_layer', dtype='float32', kernel_initializer=k_init)(h)
             y = Lambda(lambda i: i * action_range, name='lamba_output_layer')(y)
             model = Model(inputs=state_input, outputs=y)
 
         else:
-            y = Dense(action_size, activation='linear', name='critic_output_layer')(h)
+            y = dense(action_size, 'linear', 'critic_output_layer', dtype='float32')(h)
             model = Model(inputs=[state_input, action_input], outputs=y)
 
         # PNG with the architecture and summary
         if params['print_model']:
+            # pydot/graphviz are needed only here
+            from tensorflow.keras.utils import plot_model
             plot_model(model, to_file=name + '.png', show_shapes=True)    
             model.summary()
 
         return model
 
+    @staticmethod
+    def optimizer(params):
+        """Return the Adam optimizer of a model, with dynamic loss scaling for a mixed precision
+        (required by float16, optional for bfloat16 that has the float32 exponent range)
+
+        Args:
+            params (dict): precision and loss_scale of the model
+
+        Returns:
+            optimizer (Optimizer): Adam, wrapped by a LossScaleOptimizer when scaling
+        """
+
+        precision = params.get('precision', 'float32')
+        if precision == 'mixed_float16' or (precision != 'float32' and params.get('loss_scale', False)):
+            return LossScaleOptimizer(Adam())
+        return Adam()
+
+    @staticmethod
+    def forward(model, params):
+        """Return the forward pass of a model, compiled with XLA if jit_compile is in params.
+        The gradients flow through it as through the model
+
+        Args:
+            model (Model): model to compile
+            params (dict): jit_compile of the model
+
+        Returns:
+            forward (function): the model or its compiled call
+        """
+
+        if not params.get('jit_compile', False): return model
+        return tf.function(model, jit_compile=True, reduce_retracing=True)
+
     @staticmethod  
     def print_weights(model):
         """Gets the model and print its weights layer by layer
@@ -0,0 +1,172 @@
+"""Evaluator script
+
+This manages the evaluation of the deterministic actor mean μ(s|θ) (no exploration noise).
+The episodes run in parallel in a vector env, with one batched NumPy forward pass of the actor
+for each tick. During the training, the Evaluator runs them in a separate worker process (a thread
+in the runner.py workers) on a snapshot of the actor weights, so the training never waits for them: a new snapshot is taken
+only when the previous evaluation is completed, and the best snapshots are saved as .h5 models
+"""
+
+import multiprocessing as mp
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+import numpy as np
+
+from utils.policy import NumpyPolicy
+
+# Vector env of the worker process, built once by init_worker
+worker_envs = None
+
+def evaluate_policy(policy, envs, n_episodes):
+    """Run the policy without exploration noise until n_episodes are completed
+
+    Args:
+        policy (function): maps a batch of states to a batch of actions (e.g., NumpyPolicy)
+        envs (gym.vector.VectorEnv): vectorized gym environment
+        n_episodes (int): n° of episodes, split evenly among the envs
+
+    Returns:
+        returns (np.array): return of each episode
+    """
+
+    n_envs = envs.num_envs
+    # Each env performs its share of episodes, so that the short episodes are not favored
+    targets = np.full(n_envs, n_episodes // n_envs)
+    targets[:n_episodes % n_envs] += 1
+
+    ep_returns = np.zeros(n_envs)
+    counts = np.zeros(n_envs, dtype=int)
+    returns = []
+
+    states = envs.reset()
+    while len(returns) < n_episodes:
+        actions = policy(np.asarray(states, dtype=np.float32))
+        states, rewards, dones, _ = envs.step(actions)
+        ep_returns += rewards
+
+        for i in np.flatnonzero(dones):
+            if counts[i] < targets[i]:
+                returns.append(ep_returns[i])
+                counts[i] += 1
+            ep_returns[i] = 0
+
+    return np.array(returns)
+
+def init_worker(env_fn, n_envs):
+    """Build the vector env of the worker process
+
+    Args:
+        env_fn (function): builds a single env, must be picklable (e.g., functools.partial(gym.make, name))
+        n_envs (int): n° of parallel envs
+
+    Returns:
+        None
+    """
+
+    global worker_envs
+    import gym
+    worker_envs = gym.vector.SyncVectorEnv([env_fn] * n_envs)
+
+def run_evaluation(weights, action_range, n_episodes, seed):
+    """Worker task: evaluate a snapshot of the actor weights
+
+    Args:
+        weights (list): actor weights as returned by model.get_weights()
+        action_range (float): scale of the actor tanh output
+        n_episodes (int): n° of episodes
+        seed (int): seed of the envs
+
+    Returns:
+        returns (np.array): return of each episode
+    """
+
+    # Only the envs are seeded: the policy is deterministic, and in the thread of runner.py the global
+    # NumPy RNG is the one of the training (exploration noise and buffer sampling)
+    worker_envs.seed(seed)
+    return evaluate_policy(NumpyPolicy(weights, action_range), worker_envs, n_episodes)
+
+class Evaluator:
+    """
+    Class for the periodic evaluation of the actor in a worker process
+    """
+
+    def __init__(self, env_fn, model, tracker, action_range, every=50, episodes=10, n_envs=5, seed=0):
+        """Start the worker process
+
+        Args:
+            env_fn (function): builds a single env, must be picklable
+            model (Model): actor with the same architecture of the trained one, to save the best snapshots
+            tracker (Tracker): saves the results and the best models
+            action_range (float): scale of the actor tanh output
+            every (int): training episodes between two evaluations
+            episodes (int): n° of episodes of each evaluation
+            n_envs (int): n° of parallel envs of the worker
+            seed (int): seed of the evaluation envs (the same for each evaluation)
+
+        Returns:
+            None
+        """
+
+        self.model = model
+        self.tracker = tracker
+        self.action_range = action_range
+        self.every = every
+        self.episodes = episodes
+        self.seed = seed
+
+        # The workers of runner.py are daemonic and cannot start a process, so there it is a thread
+        if mp.current_process().daemon:
+            self.pool = ThreadPoolExecutor(1, initializer=init_worker, initargs=(env_fn, n_envs))
+        else:
+            self.pool = ProcessPoolExecutor(1, mp_context=mp.get_context('spawn'),
+                initializer=init_worker, initargs=(env_fn, n_envs))
+        self.pending = None
+        self.best = -np.inf
+
+    def step(self, e, actor):
+        """Called after each training episode: collect the completed evaluation and submit a
+        new snapshot when due and the worker is free
+
+        Args:
+            e (int): training episode
+            actor (Model): trained actor, or its NumpyPolicy copy (e.g., from another thread than the learner)
+
+        Returns:
+            None
+        """
+
+        if self.pending is not None and self.pending[2].done(): self.collect()
+
+        if e % self.every == 0 and self.pending is None:
+            weights = actor.get_weights()
+            self.pending = (e, weights, self.pool.submit(run_evaluation, weights, self.action_range, self.episodes, self.seed))
+
+    def collect(self):
+        """Report the pending evaluation (waiting for it) and save the snapshot if the best so far
+
+        Args:
+            None
+
+        Returns:
+            None
+        """
+
+        e, weights, future = self.pending
+        self.pending = None
+
+        returns = future.result()
+        mean, std = float(np.mean(returns)), float(np.std(returns))
+        self.tracker.save_eval([e, mean, std])
+        print(f'Eval Ep: {e}, Mean_Return: {mean}, Std_Return: {std}')
+
+        if mean > self.best:
+            self.best = mean
+            self.model.set_weights(weights)
+            self.tracker.save_model(self.model, e, round(mean, 2))
+
+    def close(self):
+        """Wait for the pending evaluation and stop the worker
+        """
+
+        if self.pending is not None: self.collect()
+        self.pool.shutdown()
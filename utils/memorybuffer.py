@@ -1,10 +1,14 @@
 """Memory buffer script
 
 This manages the memory buffer. 
+The fields are kept in memory or, if a folder is given, in np.memmap files inside it.
+With shared_next the obs_states are not stored: the obs_state of a sample is the state
+stored stride slots later (stride = n° of envs storing in turn). This is wrong only when the
+sample is terminal, whose obs_state is multiplied by done = 0 in the critic target.
 """
 
-import random
-from collections import deque
+import json
+import os
 
 import numpy as np
 
@@ -13,20 +17,115 @@ class Buffer:
     Class for the Buffer creation
     """
 
-    def __init__(self, size):
-        """Instantiate the buffer as an empty list
+    def __init__(self, size, state_shape, action_shape, folder=None, mode='w+', 
+            dtype='float32', shared_next=False, stride=1):
+        """Instantiate the buffer as a set of preallocated arrays (one for each field), used as a ring
 
         Args:
             size (int): maxsize of the buffer
+            state_shape (tuple): shape of a single state (e.g., env.observation_space.shape)
+            action_shape (tuple): shape of a single action (e.g., env.action_space.shape)
+            folder (str): if given, the fields are np.memmap files in this folder
+            mode (str): np.memmap mode ('w+' creates the files, 'r' opens them read-only)
+            dtype (str): storage type of states and actions ('float32' or 'float16')
+            shared_next (bool): recover the obs_states from the next stored states
+            stride (int): slots between a sample and its next one (n° of envs storing in turn)
+
+        Returns:
+            None
+        """
+
+        self.max_size = size
+        self.state_shape = tuple(state_shape)
+        self.action_shape = tuple(action_shape)
+        self.folder = folder
+        self.mode = mode
+        self.dtype = dtype
+        self.shared_next = shared_next
+        self.stride = stride
+
+        if folder is not None and mode != 'r': os.makedirs(folder, exist_ok=True)
+
+        self.states = self.allocate('states', (size, *state_shape), dtype)
+        self.actions = self.allocate('actions', (size, *action_shape), dtype)
+        self.rewards = self.allocate('rewards', (size,), np.float32)
+        self.obs_states = None if shared_next else self.allocate('obs_states', (size, *state_shape), dtype)
+        self.dones = self.allocate('dones', (size,), np.uint8)
+
+        # Next slot to write and n° of valid samples
+        self.ptr = 0
+        self.n_samples = 0
+
+    def allocate(self, name, shape, dtype):
+        """Create the array of a field, in memory or as a np.memmap file
+
+        Args:
+            name (str): field name, used as file name
+            shape (tuple): array shape
+            dtype (np.dtype): array type
+
+        Returns:
+            array (np.array): the zero initialized array (or the stored one in 'r' mode)
+        """
+
+        if self.folder is None:
+            return np.zeros(shape, dtype=dtype)
+        return np.memmap(os.path.join(self.folder, name + '.dat'), dtype=dtype, mode=self.mode, shape=shape)
+
+    def flush(self):
+        """Write the memmap fields and the buffer position on disk (no-op in memory)
+
+        Args:
+            None
 
         Returns:
             None
         """
 
-        self.buffer = deque(maxlen=size)
+        if self.folder is None or self.mode == 'r': return
+
+        for field in self.fields:
+            field.flush()
+
+        with open(os.path.join(self.folder, 'buffer.json'), 'w') as f:
+            json.dump(self.metadata(), f)
+
+    def metadata(self):
+        """Return the options and the position of the buffer, saved in buffer.json by flush
+        """
+
+        return {
+            'size': self.max_size,
+            'state_shape': self.state_shape,
+            'action_shape': self.action_shape,
+            'dtype': self.dtype,
+            'shared_next': self.shared_next,
+            'stride': self.stride,
+            'ptr': self.ptr,
+            'n_samples': self.n_samples
+        }
+
+    @classmethod
+    def load(cls, folder):
+        """Reopen a flushed memmap buffer read-only, without copying its fields in memory
+
+        Args:
+            folder (str): folder of the buffer
+
+        Returns:
+            buffer (Buffer): the read-only buffer, ready for sample
+        """
+
+        with open(os.path.join(folder, 'buffer.json'), 'r') as f:
+            meta = json.load(f)
+
+        buffer = cls(meta['size'], meta['state_shape'], meta['action_shape'], folder=folder, mode='r',
+            dtype=meta['dtype'], shared_next=meta['shared_next'], stride=meta['stride'])
+        buffer.ptr, buffer.n_samples = meta['ptr'], meta['n_samples']
+        return buffer
 
     def store(self, state, action, reward, obs_state, done):
-        """Append the sample in the buffer
+        """Write the sample in the next slot of the buffer, overwriting the oldest one when full
 
         Args:
             state (list): state of the agent
@@ -39,30 +138,65 @@ class Buffer:
             None
         """
 
-        self.buffer.append([state, action, reward, obs_state, done])
+        self.states[self.ptr] = state
+        self.actions[self.ptr] = action
+        self.rewards[self.ptr] = reward
+        if not self.shared_next: self.obs_states[self.ptr] = obs_state
+        self.dones[self.ptr] = done
+
+        self.ptr = (self.ptr + 1) % self.max_size
+        self.n_samples = min(self.n_samples + 1, self.max_size)
 
     def sample(self, batch_size):
         """Get the samples from the buffer
 
+        Indices are drawn uniformly (with replacement) in a single vectorized call, so each
+        field is gathered as one contiguous array
+
         Args:
             batch_size (int): size of the batch to sample
 
         Returns:
-            states (list): states of the last episode
-            actions (list): performed action in the last episode
-            rewards (float): received reward in the last episode
-            obs_states (list): observed state after the action in the last episode
-            dones (int): 1 if terminal states in the last episode
+            states (np.array): states of the last episode
+            actions (np.array): performed action in the last episode
+            rewards (np.array): received reward in the last episode
+            obs_states (np.array): observed state after the action in the last episode
+            dones (np.array): 1 if terminal states in the last episode
+        """
+
+        if self.shared_next:
+            # The last stride samples do not have their next state yet
+            offsets = np.random.randint(0, max(self.n_samples - self.stride, 1), size=batch_size)
+            idx = (self.ptr - self.stride - 1 - offsets) % self.max_size
+        else:
+            idx = np.random.randint(0, self.n_samples, size=batch_size)
+
+        return self.gather(idx)
+
+    def gather(self, idx):
+        """Get the samples at the given indices, as float32 arrays
+
+        Args:
+            idx (np.array): indices of the samples
+
+        Returns:
+            states (np.array): states of the last episode
+            actions (np.array): performed action in the last episode
+            rewards (np.array): received reward in the last episode
+            obs_states (np.array): observed state after the action in the last episode
+            dones (np.array): 1 if terminal states in the last episode
         """
-        samples = random.sample(self.buffer, batch_size)
 
-        states = np.array([sample[0] for sample in samples])
-        actions = np.array([sample[1] for sample in samples])
-        rewards = np.array([sample[2] for sample in samples])        
-        obs_states = np.array([sample[3] for sample in samples])        
-        dones = np.array([sample[4] for sample in samples])        
-        
-        return states, actions, rewards, obs_states, dones
+        if self.shared_next:
+            obs_states = self.states[(idx + self.stride) % self.max_size]
+        else:
+            obs_states = self.obs_states[idx]
+
+        return self.states[idx].astype(np.float32, copy=False), \
+            self.actions[idx].astype(np.float32, copy=False), \
+            self.rewards[idx], \
+            obs_states.astype(np.float32, copy=False), \
+            self.dones[idx].astype(np.float32)
 
     def clear(self):
         """Clear the buffer after an update of the network
@@ -73,12 +207,276 @@ class Buffer:
         Returns:
             None
         """
-        
-        self.buffer.clear()
+
+        self.ptr = 0
+        self.n_samples = 0
 
     @property
     def size(self):
         """Return the size of the buffer
         """
-        return len(self.buffer)
+        return self.n_samples
+
+    @property
+    def fields(self):
+        """Return the stored arrays
+        """
+        return [f for f in [self.states, self.actions, self.rewards, self.obs_states, self.dones] if f is not None]
+
+    @property
+    def bytes_per_transition(self):
+        """Return the bytes used to store a single transition
+        """
+        return sum(f.itemsize * int(np.prod(f.shape[1:])) for f in self.fields)
+
+
+class SumTree:
+    """
+    Class for the array-based sum-tree used by the PrioritizedBuffer
+    """
+
+    def __init__(self, size):
+        """Instantiate the tree as a single array: node i has children 2i and 2i+1, the leaves
+        start at the (power of 2) tree capacity and the root (total priority) is the node 1
+
+        Args:
+            size (int): n° of leaves
+
+        Returns:
+            None
+        """
+
+        self.depth = int(np.ceil(np.log2(max(size, 2))))
+        self.capacity = 2 ** self.depth
+        self.tree = np.zeros(2 * self.capacity, dtype=np.float64)
+
+    @property
+    def total(self):
+        """Return the sum of all the priorities
+        """
+        return self.tree[1]
+
+    def leaves(self, idx):
+        """Return the priorities of the given leaves
+        """
+        return self.tree[idx + self.capacity]
+
+    def set(self, i, priority):
+        """Set a single priority and update its ancestors
+
+        Args:
+            i (int): leaf index
+            priority (float): new priority
+
+        Returns:
+            None
+        """
+
+        pos = i + self.capacity
+        self.tree[pos] = priority
+        pos //= 2
+        while pos >= 1:
+            self.tree[pos] = self.tree[2 * pos] + self.tree[2 * pos + 1]
+            pos //= 2
+
+    def update(self, idx, priorities):
+        """Set a batch of priorities and update their ancestors level by level
+
+        Args:
+            idx (np.array): leaves indices (duplicates keep the last priority)
+            priorities (np.array): new priorities
+
+        Returns:
+            None
+        """
+
+        pos = idx + self.capacity
+        self.tree[pos] = priorities
+        for _ in range(self.depth):
+            pos = np.unique(pos // 2)
+            self.tree[pos] = self.tree[2 * pos] + self.tree[2 * pos + 1]
+
+    def find(self, values):
+        """Find the leaves of a batch of prefix sums, descending the tree for all of them at once
+
+        Args:
+            values (np.array): prefix sums in [0, total)
+
+        Returns:
+            idx (np.array): leaves indices
+        """
+
+        pos = np.ones(len(values), dtype=np.int64)
+        for _ in range(self.depth):
+            left = 2 * pos
+            left_values = self.tree[left]
+            go_right = values >= left_values
+            values = values - left_values * go_right
+            pos = left + go_right
+        return pos - self.capacity
+
+    def clear(self):
+        """Set all the priorities to 0
+        """
+        self.tree[:] = 0
+
+
+class PrioritizedBuffer(Buffer):
+    """
+    Class for the prioritized Buffer, sampling proportionally to the TD errors
+    """
+
+    def __init__(self, size, state_shape, action_shape, alpha, beta, eps=1e-6, **kwargs):
+        """Instantiate the buffer and the sum-tree of the priorities
+
+        Args:
+            size (int): maxsize of the buffer
+            state_shape (tuple): shape of a single state
+            action_shape (tuple): shape of a single action
+            alpha (float): how much prioritization is used (0 is uniform)
+            beta (float): importance sampling correction (1 is full correction)
+            eps (float): minimum priority of a sample
+            kwargs: storage options of Buffer (folder, dtype, shared_next, stride)
+
+        Returns:
+            None
+        """
+
+        super().__init__(size, state_shape, action_shape, **kwargs)
+
+        self.tree = SumTree(size)
+        self.alpha = alpha
+        self.beta = beta
+        self.eps = eps
+        self.max_priority = 1.0
+
+    def flush(self):
+        """Write the memmap fields, the buffer position and the priorities on disk (no-op in memory)
+
+        Args:
+            None
+
+        Returns:
+            None
+        """
+
+        if self.folder is None or self.mode == 'r': return
+
+        # Before buffer.json, so a buffer.json always has its priorities
+        np.save(os.path.join(self.folder, 'priorities.npy'), self.tree.tree)
+        super().flush()
+
+    def metadata(self):
+        """Return the options and the position of the buffer, with the prioritization options
+        """
+
+        return {**super().metadata(), 'alpha': float(self.alpha), 'beta': float(self.beta), 'eps': float(self.eps),
+            'max_priority': float(self.max_priority)}
+
+    @classmethod
+    def load(cls, folder):
+        """Reopen a flushed memmap buffer read-only, with its priorities (in memory)
+
+        Args:
+            folder (str): folder of the buffer
+
+        Returns:
+            buffer (PrioritizedBuffer): the read-only buffer, ready for sample
+        """
+
+        with open(os.path.join(folder, 'buffer.json'), 'r') as f:
+            meta = json.load(f)
+        if 'alpha' not in meta:
+            raise ValueError(f'{folder} is not a prioritized buffer, open it with Buffer.load')
+
+        buffer = cls(meta['size'], meta['state_shape'], meta['action_shape'], meta['alpha'], meta['beta'],
+            meta['eps'], folder=folder, mode='r', dtype=meta['dtype'], shared_next=meta['shared_next'],
+            stride=meta['stride'])
+        buffer.ptr, buffer.n_samples = meta['ptr'], meta['n_samples']
+        buffer.max_priority = meta['max_priority']
+        buffer.tree.tree = np.load(os.path.join(folder, 'priorities.npy'))
+        return buffer
+
+    def store(self, state, action, reward, obs_state, done):
+        """Append the sample in the buffer with the max priority seen so far
+
+        Args:
+            state (list): state of the agent
+            action (list): performed action
+            reward (float): received reward
+            obs_state (list): observed state after the action
+            done (int): 1 if terminal states in the last episode
+
+        Returns:
+            None
+        """
+
+        if self.shared_next:
+            # The new sample can be drawn only when its next state is stored
+            self.tree.set(self.ptr, 0)
+            if self.n_samples >= self.stride:
+                self.tree.set((self.ptr - self.stride) % self.max_size, self.max_priority)
+        else:
+            self.tree.set(self.ptr, self.max_priority)
+        super().store(state, action, reward, obs_state, done)
+
+    def sample(self, batch_size):
+        """Get the samples from the buffer, with one prefix sum drawn in each of batch_size 
+        equal segments of the total priority
+
+        Args:
+            batch_size (int): size of the batch to sample
+
+        Returns:
+            states (np.array): states of the last episode
+            actions (np.array): performed action in the last episode
+            rewards (np.array): received reward in the last episode
+            obs_states (np.array): observed state after the action in the last episode
+            dones (np.array): 1 if terminal states in the last episode
+            idx (np.array): indices of the samples, for update_priorities
+            weights (np.array): normalized importance sampling weights
+        """
+
+        total = self.tree.total
+        values = (np.arange(batch_size) + np.random.random(batch_size)) * (total / batch_size)
+        # The segments are in leaf order: shuffled, so each minibatch of an update (see SAC.learn)
+        # spans the whole buffer instead of a contiguous part of it
+        values = np.random.permutation(values)
+        # Rounding errors can reach the empty leaves after the last sample
+        idx = np.minimum(self.tree.find(values), self.n_samples - 1)
+
+        # Rounding errors can also reach a 0 priority leaf, keep its weight finite
+        probs = np.maximum(self.tree.leaves(idx), self.eps ** self.alpha) / total
+        weights = (self.n_samples * probs) ** -self.beta
+        weights = (weights / weights.max()).astype(np.float32)
+
+        return (*self.gather(idx), idx, weights)
+
+    def update_priorities(self, idx, td_errors):
+        """Update the priorities of the sampled transitions with their new TD errors
+
+        Args:
+            idx (np.array): indices returned by sample
+            td_errors (np.array): TD errors of the samples
+
+        Returns:
+            None
+        """
+
+        priorities = (np.abs(td_errors) + self.eps) ** self.alpha
+        self.max_priority = max(self.max_priority, priorities.max())
+        self.tree.update(idx, priorities)
+
+    def clear(self):
+        """Clear the buffer and its priorities
+
+        Args:
+            None
+
+        Returns:
+            None
+        """
 
+        super().clear()
+        self.tree.clear()
+        self.max_priority = 1.0
@@ -0,0 +1,123 @@
+"""NumPy policy script
+
+This manages a NumPy-only copy of the actor, used for the low-latency action selection and 
+for the deployment: an exported actor (see export.py) is a .npz with the weights and a .json 
+with the architecture, that this module loads without TensorFlow
+"""
+
+import json
+
+import numpy as np
+
+class NumpyPolicy:
+    """
+    Class for the NumPy forward pass of the actor built by DeepNetwork.build
+    """
+
+    def __init__(self, weights, action_range):
+        """Initialize the policy with the actor weights
+
+        Args:
+            weights (list): actor weights as returned by model.get_weights() (kernel, bias for each Dense)
+            action_range (float): scale of the tanh output layer
+
+        Returns:
+            None
+        """
+
+        self.action_range = np.float32(action_range)
+        self.set_weights(weights)
+
+    def set_weights(self, weights):
+        """Copy the actor weights (e.g., after some updates of the actor)
+
+        Args:
+            weights (list): actor weights as returned by model.get_weights()
+
+        Returns:
+            None
+        """
+
+        weights = [np.asarray(w, dtype=np.float32) for w in weights]
+        # Swapped with a single assignment, so a concurrent call (e.g., the collector thread
+        # of SAC.train_concurrent) uses either the old or the new weights
+        self.layers = list(zip(weights[0::2], weights[1::2]))
+
+    def get_weights(self):
+        """Return the actor weights, as model.get_weights(), from a single read of the layers
+        (a consistent snapshot even while another thread calls set_weights)
+        """
+
+        return [w for layer in self.layers for w in layer]
+
+    @classmethod
+    def load(cls, path):
+        """Load an exported actor
+
+        Args:
+            path (str): path of the export, without extension (path.npz and path.json)
+
+        Returns:
+            policy (NumpyPolicy): the policy
+        """
+
+        with open(path + '.json', 'r') as f:
+            spec = json.load(f)
+
+        # The forward pass of __call__
+        activations = [layer['activation'] for layer in spec['layers']]
+        assert activations == ['relu'] * (len(activations) - 1) + ['tanh'], f'unsupported activations {activations}'
+
+        with np.load(path + '.npz') as data:
+            weights = [data[name] for layer in spec['layers'] for name in (layer['name'] + '_kernel', layer['name'] + '_bias')]
+        return cls(weights, spec['action_range'])
+
+    def save(self, path):
+        """Export the actor as path.npz (weights) and path.json (architecture)
+
+        Args:
+            path (str): path of the export, without extension
+
+        Returns:
+            None
+        """
+
+        names = ['hidden_' + str(i) for i in range(len(self.layers) - 1)] + ['actor_output_layer']
+        spec = {
+            'format': 'sac-numpy-actor/1',
+            'input_size': int(self.layers[0][0].shape[0]),
+            'action_size': int(self.layers[-1][0].shape[1]),
+            'action_range': float(self.action_range),
+            'layers': [{'name': name, 'units': int(b.shape[0]), 'activation': 'relu'} for name, (_, b) in zip(names, self.layers)]
+        }
+        spec['layers'][-1]['activation'] = 'tanh'
+
+        np.savez(path + '.npz', **{
+            name + suffix: w for name, layer in zip(names, self.layers) for suffix, w in zip(('_kernel', '_bias'), layer)
+        })
+        with open(path + '.json', 'w') as f:
+            json.dump(spec, f, indent=2)
+
+    def __call__(self, states):
+        """Compute μ(s|θ) for a single state or a batch of states
+
+        Args:
+            states (np.array): state with shape (state size,) or batch with shape (n°, state size)
+
+        Returns:
+            mu (np.array): actor output with the same leading shape of states
+        """
+
+        *hidden, (k_out, b_out) = self.layers
+
+        h = np.asarray(states, dtype=np.float32)
+        for k, b in hidden:
+            h = h @ k
+            h += b
+            np.maximum(h, 0, out=h)
+
+        y = h @ k_out
+        y += b_out
+        np.tanh(y, out=y)
+        y *= self.action_range
+        return y
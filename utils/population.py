@@ -0,0 +1,282 @@
+"""Population script
+
+This manages the training of a population of independent SAC agents in a single graph.
+The actors and the critics of the agents are stacked along a leading agents axis (see
+DeepNetwork.build with n_agents), so the action selection of all the agents is one batched
+forward pass and their updates are one compiled step. Each agent has its own env, replay buffer,
+Tracker and per-agent hyperparameters (member_keys), while the networks, buffer and update
+sections are shared. The agents learn exactly as separate ones: no op mixes the agents axis,
+and Adam is elementwise, so one optimizer on the stacked weights updates each agent as its own
+"""
+
+from collections import deque
+
+import numpy as np
+import tensorflow as tf
+
+from agent import SAC
+from utils.deepnetwork import DeepNetwork
+from utils.memorybuffer import Buffer
+
+# Agent params that can differ between the agents of a population
+member_keys = ['gamma', 'tau', 'alpha', 'alpha_scale', 'alpha_decay', 'alpha_min', 'alpha_scaling_type',
+    'std', 'std_scale', 'std_decay', 'std_min', 'std_scaling_type']
+
+class Population:
+    """
+    Class for a population of SAC agents with stacked networks
+    """
+
+    def __init__(self, envs, params, members, seeds, print_episodes=True):
+        """Initialize the stacked networks, the optimizers and the buffer of each agent
+
+        Args:
+            envs (list): one gym env for each agent
+            params (dict): agent parameters shared by the population (e.g., dnn structure)
+            members (list): agent parameters of each agent, that differ only in the member_keys
+            seeds (list): seed of the exploration noise of each agent
+            print_episodes (bool): print each episode (e.g., False when watched through the telemetry)
+
+        Returns:
+            None
+        """
+
+        self.envs = envs
+        self.n_agents = len(envs)
+        self.members = members
+        self.print_episodes = print_episodes
+        env = envs[0]
+
+        assert params['buffer']['type'] == 'uniform' and params['buffer']['storage'] == 'memory', \
+            'the population samples uniformly from memory buffers'
+
+        # The critics of each agent are stacked as the fused ensemble (n_critics for each agent)
+        self.n_critics = params['critic']['n_critics']
+        assert self.n_critics >= 2, 'the clipped double Q target needs n_critics >= 2'
+        self.actor = DeepNetwork.build(env, params['actor'], actor=True, name='actor', n_agents=self.n_agents)
+        self.actor_opt = DeepNetwork.optimizer(params['actor'])
+        self.critic = DeepNetwork.build(env, params['critic'], name='critic', n_agents=self.n_agents)
+        self.critic_tg = DeepNetwork.build(env, params['critic'], name='critic_tg', n_agents=self.n_agents)
+        self.critic_tg.set_weights(self.critic.get_weights())
+        self.critic_opt = DeepNetwork.optimizer(params['critic'])
+
+        self.buffers = [
+            Buffer(
+                params['buffer']['size'],
+                env.observation_space.shape,
+                env.action_space.shape,
+                dtype=params['buffer']['dtype'],
+                shared_next=params['buffer']['shared_next']
+            ) for _ in range(self.n_agents)
+        ]
+
+        # Each agent draws its exploration noise from its own generator
+        self.rngs = [np.random.default_rng(seed) for seed in seeds]
+
+        self.actor_fn = tf.function(
+            lambda s: self.actor(s, training=False),
+            jit_compile=params['actor']['jit_compile'],
+            input_signature=[tf.TensorSpec((self.n_agents, None, *env.observation_space.shape), tf.float32)]
+        ).get_concrete_function()
+
+        # The batches have a static shape (see update), so it is traced (and compiled by XLA) once
+        self.train_step = tf.function(
+            self.fused_update,
+            jit_compile=params['update']['jit_compile']
+        )
+
+        self.grad_steps = params['update']['grad_steps']
+        self.update_every = params['update']['every']
+
+    def get_actions(self, states, std):
+        """Get the actions to perform, one for each agent
+
+        Args:
+            states (np.array): current state of each agent, shape (n° agents, state size)
+            std (np.array): Gaussian distribution std of each agent
+
+        Returns:
+            actions (np.array): sampled actions to perform, shape (n° agents, action size)
+        """
+
+        mu = self.actor_fn(tf.constant(states[:, None], dtype=tf.float32)).numpy()[:, 0]
+        noise = np.stack([rng.standard_normal(mu.shape[1]) for rng in self.rngs])
+        return mu + std[:, None] * noise
+
+    def update(self, batch_size, gamma, std, alpha, tau):
+        """Sample a batch from the buffer of each agent and perform the gradient steps of an update,
+        as SAC.update for each agent
+
+        Args:
+            batch_size (int): batch size of each agent
+            gamma (np.array): discount factor of each agent
+            std (np.array): Gaussian distribution std of each agent
+            alpha (np.array): tradeoff coefficient of each agent
+            tau (np.array): target networks update rate of each agent
+
+        Returns:
+            losses (tf.Tensor): critic losses of the last gradient step, shape (n° agents, n° critics)
+        """
+
+        # Always the full batch_size, drawn with replacement, so the shapes are static (see SAC.sample_batch)
+        samples = [b.sample(batch_size * self.grad_steps) for b in self.buffers]
+
+        # Shape (n° agents, n° samples, len(metric))
+        states, actions, rewards, obs_states, dones = [
+            tf.convert_to_tensor(np.stack(field).astype(np.float32, copy=False).reshape(self.n_agents, len(field[0]), -1))
+            for field in zip(*samples)
+        ]
+
+        # Shape (n° agents, 1, 1), to broadcast over the samples and the actions
+        gamma, std, alpha, tau = [tf.constant(np.reshape(v, (-1, 1, 1)), dtype=tf.float32) for v in (gamma, std, alpha, tau)]
+
+        for i in range(self.grad_steps):
+            b = slice(i * batch_size, (i + 1) * batch_size)
+            losses = self.train_step(gamma, std, states[:, b], actions[:, b], rewards[:, b],
+                obs_states[:, b], dones[:, b], alpha, tau)
+        return losses
+
+    def fused_update(self, gamma, std, states, actions, rewards, obs_states, dones, alpha, tau):
+        """SAC.fused_update of all the agents, on samples and hyperparameters with a leading agents axis.
+        The losses are summed over the agents: each one depends only on the weights of its own agent,
+        so the gradient of the sum is the gradient of each agent. It is wrapped by tf.function in __init__
+
+        Args:
+            gamma (tf.Tensor): discount factors
+            std (tf.Tensor): Gaussian distribution stds for action selection
+            states (tf.Tensor): sampled states for the update
+            actions (tf.Tensor): sampled actions for the update
+            rewards (tf.Tensor): sampled rewards for the update
+            obs_states (tf.Tensor): sampled obs_states for the update
+            dones (tf.Tensor): sampled dones for the update
+            alpha (tf.Tensor): tradeoff coefficients
+            tau (tf.Tensor): target networks update rates
+
+        Returns:
+            critic_losses (tf.Tensor): loss of each critic of each agent
+        """
+
+        # A single forward pass of π(s'|θ), for the critic target and for a_squash(s|θ)
+        with tf.GradientTape() as tape_a:
+            mu = self.actor(obs_states)
+
+        # Compute the min Q_targ(s',π(s'|θ)) of each agent
+        tg_mu = tf.stop_gradient(mu)
+        tg_actions = tg_mu + std * tf.random.normal(shape=tf.shape(mu))
+        min_tg_values = tf.math.reduce_min(self.critic_values(obs_states, tg_actions, target=True), axis=1)
+
+        # Compute α log π(π(s'|θ)|s')
+        gauss_d = std * tf.sqrt(2 * np.pi)
+        gauss_n = tf.math.exp(-0.5 * ((tg_actions - tg_mu) / std)**2)
+        gauss_p = tf.math.reduce_mean(gauss_n / gauss_d, axis=2, keepdims=True)
+        log_p = alpha * tf.math.log(gauss_p)
+
+        critic_targets = rewards + gamma * min_tg_values * dones
+        critic_targets = tf.stop_gradient(critic_targets - log_p)
+
+        # Update the critics minimizing mse (Q(s, a) - y)
+        with tf.GradientTape() as tape_c:
+            td_errors = critic_targets[:, None] - self.critic_values(states, actions)
+            critic_losses = tf.math.reduce_mean(tf.math.square(td_errors), axis=[2, 3])
+
+        SAC.apply_gradients(tape_c, critic_losses, self.critic.trainable_variables, self.critic_opt)
+
+        # Update the actors with (minQ(s,a_squash(s|θ)) - α log π(a_squash(s|θ)|θ))
+        with tape_a:
+            action_squashed = tf.math.tanh(mu + tf.random.normal(shape=tf.shape(mu)))
+
+            gauss_n = tf.math.exp(-0.5 * ((action_squashed - mu) / std)**2)
+            gauss_p = tf.math.reduce_mean(gauss_n / gauss_d, axis=2, keepdims=True)
+            log_p = alpha * tf.math.log(gauss_p)
+
+            min_values = tf.stop_gradient(tf.math.reduce_min(self.critic_values(states, action_squashed), axis=1))
+
+            actor_objective = -tf.math.reduce_mean(min_values - log_p, axis=[1, 2])
+
+        SAC.apply_gradients(tape_a, actor_objective, self.actor.trainable_variables, self.actor_opt)
+
+        # Polyak update of the target critics, with the τ of each agent for each of its critics
+        tau = tf.repeat(tau, self.n_critics, axis=0)
+        tf.group([tw.assign_add(tau * (w - tw)) for (w, tw) in zip(self.critic.variables, self.critic_tg.variables)])
+
+        return critic_losses
+
+    def critic_values(self, states, actions, target=False):
+        """Compute Q(s, a) of all the critics of each agent
+
+        Args:
+            states (tf.Tensor): states of each agent
+            actions (tf.Tensor): actions of each agent
+
+        Returns:
+            values (tf.Tensor): values, shape (n° agents, n° critics, batch, action size)
+        """
+
+        critic = self.critic_tg if target else self.critic
+        values = critic([states, actions])
+        return tf.reshape(values, (self.n_agents, self.n_critics, -1, values.shape[-1]))
+
+    def train(self, trackers, n_episodes, verbose, params):
+        """Main loop of the population: the agents step their envs together, and each one stores
+        its samples in its own buffer and its episodes in its own Tracker. The agents that completed
+        n_episodes keep stepping (untracked) until the last one completes them
+
+        Args:
+            trackers (list): Tracker of each agent
+            n_episodes (int): n° of episodes of each agent
+            verbose (int): how frequent we save the training stats
+            params (dict): agent parameters shared by the population (e.g., the batch size)
+
+        Returns:
+            None
+        """
+
+        members = self.members
+        gamma, tau = [np.array([m[key] for m in members]) for key in ('gamma', 'tau')]
+        std, alpha = [np.array([m[key] for m in members], dtype=np.float64) for key in ('std', 'alpha')]
+
+        mean_rewards = [deque(maxlen=100) for _ in range(self.n_agents)]
+        episodes = np.zeros(self.n_agents, dtype=int)
+        ep_rewards = np.zeros(self.n_agents)
+
+        states = np.array([env.reset() for env in self.envs], dtype=np.float32)
+        # Env steps of each agent (e.g., for the throughput of the results index)
+        self.steps = steps = 0
+
+        while episodes.min() < n_episodes:
+            actions = self.get_actions(states, std)
+
+            for k, env in enumerate(self.envs):
+                obs_state, obs_reward, done, _ = env.step(actions[k])
+                self.buffers[k].store(states[k], actions[k], obs_reward, obs_state, 1 - int(done))
+                ep_rewards[k] += obs_reward
+
+                if done:
+                    if episodes[k] < n_episodes:
+                        e, m = episodes[k], members[k]
+                        mean_rewards[k].append(ep_rewards[k])
+                        trackers[k].update([e, ep_rewards[k]])
+                        if e % verbose == 0: trackers[k].save_metrics()
+
+                        if self.print_episodes:
+                            print(f'Agent: {k}, Ep: {e}, Ep_Rew: {ep_rewards[k]}, Mean_Rew: {np.mean(mean_rewards[k])}')
+
+                        if m['std_scale']:
+                            std[k] = SAC.scale_value(std[k], m['std_scaling_type'], m['std_decay'], m['std_min'], e, mean_rewards[k])
+                        if m['alpha_scale']:
+                            alpha[k] = SAC.scale_value(alpha[k], m['alpha_scaling_type'], m['alpha_decay'], m['alpha_min'], e, mean_rewards[k])
+
+                    episodes[k] += 1
+                    ep_rewards[k] = 0
+                    obs_state = env.reset()
+
+                states[k] = obs_state
+
+            steps += 1
+            self.steps = steps
+
+            if steps >= 100 and steps % self.update_every == 0:
+                losses = self.update(params['buffer']['batch'], gamma, std, alpha, tau).numpy()
+                for k, tracker in enumerate(trackers):
+                    if episodes[k] < n_episodes:
+                        tracker.log_step(steps, [steps, *losses[k, :2], alpha[k], std[k]])
@@ -0,0 +1,69 @@
+"""Prefetcher script
+
+This manages a background thread that samples the next batches while the current update
+runs, keeping at most depth batches ready in a bounded queue (depth 2 is a double buffer).
+The depth also bounds how stale a batch (and its priorities) can be when it is used.
+"""
+
+import queue
+import threading
+
+class Prefetcher:
+    """
+    Class for the batch prefetching thread
+    """
+
+    def __init__(self, sample_fn, depth=2):
+        """Start the thread
+
+        Args:
+            sample_fn (function): returns the next batch (e.g., SAC.sample_batch)
+            depth (int): max n° of batches ready in advance
+
+        Returns:
+            None
+        """
+
+        self.sample_fn = sample_fn
+        self.queue = queue.Queue(maxsize=depth)
+        self.stopped = threading.Event()
+        self.error = None
+
+        self.thread = threading.Thread(target=self.loop, daemon=True)
+        self.thread.start()
+
+    def loop(self):
+        """Sample batches until close, waiting while the queue is full
+        """
+
+        try:
+            while not self.stopped.is_set():
+                batch = self.sample_fn()
+                while not self.stopped.is_set():
+                    try:
+                        self.queue.put(batch, timeout=.1)
+                        break
+                    except queue.Full:
+                        pass
+        except Exception as error:
+            # Raised again by get
+            self.error = error
+            self.stopped.set()
+
+    def get(self):
+        """Return the oldest ready batch, waiting for it if needed
+        """
+
+        while True:
+            try:
+                return self.queue.get(timeout=.1)
+            except queue.Empty:
+                if self.error is not None: raise self.error
+
+    def close(self):
+        """Stop the thread and drop the ready batches
+        """
+
+        self.stopped.set()
+        self.thread.join()
+        while not self.queue.empty(): self.queue.get_nowait()
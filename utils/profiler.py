@@ -0,0 +1,173 @@
+"""Profiler script for the training hot path
+
+This collects the wall time of each phase of a training step (get_action, env_step,
+buffer_store, buffer_sample, update...) in log-spaced histograms and periodically reports
+them through the Tracker, with steps/sec, gradient steps/sec, RSS and replay buffer bytes.
+It can also capture a TF profiler trace for a window of steps.
+"""
+
+import os
+import resource
+import threading
+import time
+
+import numpy as np
+
+# Histogram bin edges: 1us to 10s, 4 bins for each decade
+bin_edges = np.logspace(-6, 1, 29)
+
+class Profiler:
+    """
+    Class for the per-phase training profiler
+    """
+
+    def __init__(self, enabled=False, report_every=1000, trace_start=0, trace_steps=0, trace_dir=None):
+        """Initialize the profiler
+
+        Args:
+            enabled (bool): if False tic/toc do nothing
+            report_every (int): env steps between two reports
+            trace_start (int): env step at which the TF trace starts
+            trace_steps (int): env steps to trace (0 disables the TF trace)
+            trace_dir (str): log folder of the TF trace
+
+        Returns:
+            None
+        """
+
+        self.enabled = enabled
+        self.report_every = report_every
+        self.trace_start = trace_start
+        self.trace_steps = trace_steps
+        self.trace_dir = trace_dir
+        self.tracing = False
+        # Total env steps, kept also when disabled (e.g., for the throughput of the results index)
+        self.steps = 0
+        # tic/toc can be called by the collector and the learner threads (see SAC.train_concurrent)
+        self.lock = threading.Lock()
+
+        self.reset()
+
+    def reset(self):
+        """Start a new report window
+
+        Args:
+            None
+
+        Returns:
+            None
+        """
+
+        self.hists = {}
+        self.totals = {}
+        self.window_start = time.perf_counter()
+        self.window_steps = 0
+        self.window_grad_steps = 0
+
+    def tic(self):
+        """Return the start time of a phase (0 when disabled)
+        """
+        return time.perf_counter() if self.enabled else 0
+
+    def toc(self, phase, t0):
+        """Add the elapsed time since t0 to the phase histogram
+
+        Args:
+            phase (str): phase name
+            t0 (float): value returned by tic
+
+        Returns:
+            None
+        """
+
+        if not self.enabled: return
+
+        elapsed = time.perf_counter() - t0
+        with self.lock:
+            if phase not in self.hists:
+                self.hists[phase] = np.zeros(len(bin_edges) + 1, dtype=np.int64)
+                self.totals[phase] = 0.
+            self.hists[phase][np.searchsorted(bin_edges, elapsed)] += 1
+            self.totals[phase] += elapsed
+
+    def step(self, steps, n_steps, grad_steps, tracker, buffer):
+        """Account the env steps and gradient steps just performed, start/stop the TF trace
+        and report to the tracker when a window is completed
+
+        Args:
+            steps (int): total env steps
+            n_steps (int): env steps performed since the last call
+            grad_steps (int): gradient steps performed since the last call
+            tracker (Tracker): receives the report
+            buffer (Buffer): replay buffer, for its bytes
+
+        Returns:
+            None
+        """
+
+        self.steps = steps
+        if not self.enabled: return
+
+        if self.trace_steps:
+            if not self.tracing and self.trace_start <= steps < self.trace_start + self.trace_steps:
+                import tensorflow as tf
+                tf.profiler.experimental.start(self.trace_dir)
+                self.tracing = True
+            elif self.tracing and steps >= self.trace_start + self.trace_steps:
+                import tensorflow as tf
+                tf.profiler.experimental.stop()
+                self.tracing = False
+
+        self.window_steps += n_steps
+        self.window_grad_steps += grad_steps
+        if self.window_steps >= self.report_every:
+            with self.lock:
+                tracker.save_profile(self.report(steps, buffer))
+                self.reset()
+
+    def report(self, steps, buffer):
+        """Summarize the current window
+
+        Args:
+            steps (int): total env steps
+            buffer (Buffer): replay buffer, for its bytes
+
+        Returns:
+            report (dict): throughput, memory and per-phase stats (ms)
+        """
+
+        elapsed = time.perf_counter() - self.window_start
+        report = {
+            'step': steps,
+            'steps_per_sec': self.window_steps / elapsed,
+            'grad_steps_per_sec': self.window_grad_steps / elapsed,
+            'rss_bytes': rss_bytes(),
+            'buffer_bytes': sum(int(f.nbytes) for f in buffer.fields),
+            'phases': {}
+        }
+
+        for phase, hist in self.hists.items():
+            count = int(hist.sum())
+            cum = np.cumsum(hist)
+            # Upper edge of the bin containing the percentile
+            edges = np.append(bin_edges, np.inf)
+            report['phases'][phase] = {
+                'count': count,
+                'mean_ms': 1e3 * self.totals[phase] / count,
+                'p50_ms': 1e3 * edges[np.searchsorted(cum, .5 * count)],
+                'p99_ms': 1e3 * edges[np.searchsorted(cum, .99 * count)],
+                'share': self.totals[phase] / elapsed,
+                'hist': hist.tolist()
+            }
+        return report
+
+def rss_bytes():
+    """Return the current resident set size of the process (peak RSS if /proc is not available)
+    """
+
+    try:
+        with open('/proc/self/statm', 'r') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError):
+        # ru_maxrss is in KB on Linux
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
@@ -0,0 +1,203 @@
+"""Results index script
+
+This manages a local SQLite index of the training runs. A run is identified by the hash of
+its resolved config (config_id, the same for all the seeds of a config) and by the hash of the
+config together with the seed (run_id), instead of the Tracker file name that ignores most of the
+parameters. The index stores the run metadata, the throughput and the reward of each episode,
+so that an identical config + seed is skipped when launched again (see main.py) and the graphs
+can be generated from it (see generate_graphs.py)
+"""
+
+import copy
+import hashlib
+import json
+import os
+import socket
+import sqlite3
+import threading
+import time
+
+import numpy as np
+
+root_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Keys that do not change the results of a run, left out of the hashes
+ignored_keys = ['train.verbose', 'train.log', 'train.profile', 'train.results_db', 'train.telemetry']
+
+schema = '''
+CREATE TABLE IF NOT EXISTS runs (
+    run_id TEXT PRIMARY KEY,
+    config_id TEXT NOT NULL,
+    seed INTEGER NOT NULL,
+    env TEXT,
+    label TEXT,
+    config TEXT,
+    status TEXT,
+    host TEXT,
+    started REAL,
+    finished REAL,
+    episodes INTEGER,
+    steps INTEGER,
+    duration REAL,
+    steps_per_sec REAL
+);
+CREATE INDEX IF NOT EXISTS runs_config ON runs (config_id);
+CREATE TABLE IF NOT EXISTS episodes (
+    run_id TEXT NOT NULL,
+    episode INTEGER NOT NULL,
+    reward REAL,
+    PRIMARY KEY (run_id, episode)
+);
+'''
+
+def db_path(path):
+    """Return the index path, relative paths are relative to the repo (the runs can change directory)
+    """
+    return path if os.path.isabs(path) else os.path.join(root_dir, path)
+
+def config_id(cfg):
+    """Return the canonical hash of a config, without its seed and the ignored keys
+
+    Args:
+        cfg (dict): resolved config
+
+    Returns:
+        config_id (str): hex digest
+    """
+
+    cfg = copy.deepcopy(cfg)
+    cfg['setup'].pop('seed', None)
+    for key in ignored_keys:
+        section, name = key.split('.')
+        cfg.get(section, {}).pop(name, None)
+
+    canonical = json.dumps(cfg, sort_keys=True, separators=(',', ':'))
+    return hashlib.sha256(canonical.encode()).hexdigest()[:16]
+
+def run_id(cfg, seed):
+    """Return the hash of a config together with the seed of the run
+    """
+    return hashlib.sha256(f'{config_id(cfg)}/{seed}'.encode()).hexdigest()[:16]
+
+class ResultsDB:
+    """
+    Class for the SQLite index of the runs
+    """
+
+    def __init__(self, path):
+        """Open (or create) the index
+
+        Args:
+            path (str): .db file (relative to the repo)
+
+        Returns:
+            None
+        """
+
+        self.path = db_path(path)
+        # The Tracker writer thread adds the episodes, parallel runs (e.g., runner.py) share the file
+        self.conn = sqlite3.connect(self.path, timeout=60, check_same_thread=False)
+        self.lock = threading.Lock()
+        with self.lock, self.conn:
+            self.conn.execute('PRAGMA journal_mode=WAL')
+            self.conn.executescript(schema)
+
+    def completed(self, run_id):
+        """Return True if the run is already completed
+        """
+
+        with self.lock:
+            row = self.conn.execute('SELECT status FROM runs WHERE run_id = ?', (run_id,)).fetchone()
+        return row is not None and row[0] == 'completed'
+
+    def start(self, cfg, seed, label=None):
+        """Record the start of a run, replacing a previous incomplete one with the same run_id
+
+        Args:
+            cfg (dict): resolved config
+            seed (int): seed of the run
+            label (str): name of the run group (e.g., the testN folder)
+
+        Returns:
+            run_id (str): id of the run
+        """
+
+        rid = run_id(cfg, seed)
+        with self.lock, self.conn:
+            self.conn.execute('DELETE FROM episodes WHERE run_id = ?', (rid,))
+            self.conn.execute(
+                'INSERT OR REPLACE INTO runs (run_id, config_id, seed, env, label, config, status, host, started) '
+                'VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                (rid, config_id(cfg), seed, cfg['train']['name'], label, json.dumps(cfg), 'running',
+                    socket.gethostname(), time.time())
+            )
+        return rid
+
+    def add_episodes(self, run_id, rows):
+        """Add the rewards of a set of episodes
+
+        Args:
+            run_id (str): id of the run
+            rows (list): [episode, reward] rows (e.g., the rows of the Tracker .csv)
+
+        Returns:
+            None
+        """
+
+        with self.lock, self.conn:
+            self.conn.executemany('INSERT OR REPLACE INTO episodes VALUES (?, ?, ?)',
+                [(run_id, int(e), float(r)) for e, r, *_ in rows])
+
+    def finish(self, run_id, status, steps, duration):
+        """Record the end of a run and its throughput, after its episodes (e.g., after Tracker.close)
+
+        Args:
+            run_id (str): id of the run
+            status (str): 'completed', 'stopped' (e.g., by the sweep scheduler) or 'failed'
+            steps (int): env steps of the run
+            duration (float): seconds of the training loop
+
+        Returns:
+            None
+        """
+
+        with self.lock, self.conn:
+            self.conn.execute(
+                'UPDATE runs SET status = ?, finished = ?, steps = ?, duration = ?, steps_per_sec = ?, '
+                'episodes = (SELECT COUNT(*) FROM episodes WHERE run_id = ?) WHERE run_id = ?',
+                (status, time.time(), steps, duration, steps / max(duration, 1e-9), run_id, run_id)
+            )
+
+    def runs(self, status='completed', **filters):
+        """Return the runs with the given status and column values
+
+        Args:
+            status (str): status of the runs (None for any)
+            filters (dict): column values (e.g., env='LunarLanderContinuous-v2')
+
+        Returns:
+            runs (list): a dict for each run, with the config parsed
+        """
+
+        if status is not None: filters['status'] = status
+        where = ' AND '.join(f'{column} = ?' for column in filters) or '1'
+        with self.lock:
+            cursor = self.conn.execute(f'SELECT * FROM runs WHERE {where} ORDER BY started', tuple(filters.values()))
+            columns = [d[0] for d in cursor.description]
+            runs = [dict(zip(columns, row)) for row in cursor.fetchall()]
+
+        for run in runs: run['config'] = json.loads(run['config'])
+        return runs
+
+    def rewards(self, run_id):
+        """Return the reward of each episode of a run
+        """
+
+        with self.lock:
+            rows = self.conn.execute('SELECT reward FROM episodes WHERE run_id = ? ORDER BY episode', (run_id,)).fetchall()
+        return np.array([r for r, in rows])
+
+    def close(self):
+        """Close the connection
+        """
+        self.conn.close()
@@ -0,0 +1,156 @@
+"""Telemetry script
+
+This manages the live telemetry stream of a run, fed by the Tracker. The Tracker hands over the
+episode rewards and the per-step metrics (losses, alpha, std) by reference, and a record is built
+only when due (every few seconds): the rolling episode reward, the steps/sec since the last record
+and the last step metrics. Each record is appended as a json line (or as TensorBoard scalars) and
+optionally sent as a datagram to the Unix socket of monitor.py, without blocking nor failing when
+no monitor is listening. So dozens of runs on one host can be watched at a negligible cost
+"""
+
+from collections import deque
+import importlib.util
+import json
+import socket
+import threading
+import time
+
+import numpy as np
+
+# tf.summary.scalar requires tensorboard, optional as pyarrow (see Tracker)
+has_tensorboard = importlib.util.find_spec('tensorboard') is not None
+
+class Telemetry:
+    """
+    Class for the rate-limited telemetry stream of a run
+    """
+
+    def __init__(self, run, names, every=5., format='jsonl', path=None, socket_path='', window=100):
+        """Open the outputs of the stream
+
+        Args:
+            run (str): name of the run in the records
+            names (list): names of the per-step metrics (e.g., the step_metrics of the Tracker)
+            every (float): min seconds between two records
+            format (str): 'jsonl', 'tensorboard' or '' (socket only)
+            path (str): .jsonl file or TensorBoard log folder
+            socket_path (str): Unix datagram socket of the monitor ('' for none)
+            window (int): episodes of the rolling reward
+
+        Returns:
+            None
+        """
+
+        self.run = run
+        self.names = names
+        self.every = every
+        self.format = format
+
+        self.file = open(path, 'a') if format == 'jsonl' else None
+        self.writer = None
+        if format == 'tensorboard':
+            import tensorflow as tf
+            self.writer = tf.summary.create_file_writer(path)
+
+        self.socket_path = socket_path
+        self.sock = None
+        if socket_path:
+            self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+            self.sock.setblocking(False)
+
+        self.rewards = deque(maxlen=window)
+        self.episode = -1
+        self.steps = 0
+        self.metrics = None
+        self.dropped = 0
+
+        self.last_time = time.monotonic()
+        self.last_steps = 0
+        self.next_emit = self.last_time + every
+        # The collector and the learner threads can both feed it (see SAC.train_concurrent)
+        self.lock = threading.Lock()
+
+    def add_episode(self, e, reward):
+        """Account a completed episode
+
+        Args:
+            e (int): episode
+            reward (float): episode reward
+
+        Returns:
+            None
+        """
+
+        self.episode = e
+        self.rewards.append(reward)
+        if time.monotonic() >= self.next_emit: self.emit()
+
+    def add_step(self, steps, metrics):
+        """Keep the last per-step metrics, not converted until a record is due
+
+        Args:
+            steps (int): total env steps
+            metrics (list): values of the per-step metrics (tensors or floats)
+
+        Returns:
+            None
+        """
+
+        self.steps = steps
+        self.metrics = metrics
+        if time.monotonic() >= self.next_emit: self.emit()
+
+    def emit(self, force=False):
+        """Build a record and write/send it, if still due
+
+        Args:
+            force (bool): emit even if not due (e.g., the last record)
+
+        Returns:
+            None
+        """
+
+        with self.lock:
+            now = time.monotonic()
+            # Another thread may have emitted it
+            if now < self.next_emit and not force: return
+
+            record = {
+                'run': self.run,
+                'time': time.time(),
+                'episode': int(self.episode),
+                'steps': int(self.steps),
+                'steps_per_sec': (self.steps - self.last_steps) / max(now - self.last_time, 1e-9),
+                'reward_mean': float(np.mean(self.rewards)) if self.rewards else None,
+                'reward_last': float(self.rewards[-1]) if self.rewards else None
+            }
+            if self.metrics is not None:
+                record.update({name: float(v) for name, v in zip(self.names, self.metrics) if name != 'Step'})
+
+            self.last_time, self.last_steps = now, self.steps
+            self.next_emit = now + self.every
+
+            if self.file is not None:
+                self.file.write(json.dumps(record) + '\n')
+                self.file.flush()
+            elif self.writer is not None:
+                import tensorflow as tf
+                with self.writer.as_default(step=self.steps):
+                    for name, value in record.items():
+                        if name not in ('run', 'time', 'steps') and value is not None: tf.summary.scalar(name, value)
+
+            if self.sock is not None:
+                try:
+                    self.sock.sendto(json.dumps(record).encode(), self.socket_path)
+                except OSError:
+                    # No monitor listening, or its queue is full
+                    self.dropped += 1
+
+    def close(self):
+        """Emit the last record and close the outputs
+        """
+
+        self.emit(force=True)
+        if self.file is not None: self.file.close()
+        if self.writer is not None: self.writer.close()
+        if self.sock is not None: self.sock.close()
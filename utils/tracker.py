@@ -1,17 +1,36 @@
 """Tracker script for saving the model and the training stats
 
-This instantiates the Tracker and manages it
+This instantiates the Tracker and manages it.
+The files are written by a background thread fed through a bounded queue: the episode
+metrics go in the .csv, the (sampled) per-step metrics in columnar npz or parquet shards.
+The episodes and the per-step metrics also feed the live telemetry stream, if enabled (see Telemetry)
 """
 
+import importlib.util
+import json
 import os
+import queue
+import threading
+
 import numpy as np
 
+from utils.telemetry import Telemetry, has_tensorboard
+
+# pyarrow is optional, and imported by the writer only when used
+has_pyarrow = importlib.util.find_spec('pyarrow') is not None
+
+class StopTraining(Exception):
+    """
+    Raised by Tracker.update when the on_episode callback stops the run (e.g., by the sweep scheduler)
+    """
+
 class Tracker:
     """
     A class used to represent the stats Tracker
     """
 
-    def __init__(self, env_name, tag, seed, params, metrics):
+    def __init__(self, env_name, tag, seed, params, metrics, step_metrics=None, log=None, on_episode=None, folder='results/', on_save=None,
+            telemetry=None, run_name=None):
         """Gets the training details and initiate the Tracker
 
         Args:
@@ -20,6 +39,18 @@ class Tracker:
             seed (int): training seed
             params (dict): dnn parameters for the .csv name
             metrics (list): metrics to save in the .csv
+            step_metrics (list): per-step metrics to save in the shards
+            log (dict): step_every (0 disables the per-step metrics), queue_size, 
+                shard_size and format ('npz' or 'parquet') of the per-step metrics
+            on_episode (function): called with the metrics of each episode, the training stops
+                (raising StopTraining) when it returns False
+            folder (str): output folder (e.g., one for each member of a population)
+            on_save (function): called by the writer thread with the episode rows appended to
+                the .csv (e.g., ResultsDB.add_episodes of the run)
+            telemetry (dict): every (seconds between two records, 0 disables the stream), format
+                ('jsonl' in the _telemetry.jsonl file, 'tensorboard' in telemetry/ or '' for the socket only)
+                and socket (Unix socket of monitor.py, '' for none) of the telemetry stream
+            run_name (str): name of the run in the telemetry stream (save_tag@pid if None)
         """
 
         self.save_tag = env_name + \
@@ -28,11 +59,14 @@ class Tracker:
             '_' + str(params['actor']['h_layers']) + \
             'x' + str(params['actor']['h_size'])
 
-        folder_name = 'results/'
+        folder_name = folder
         if not os.path.exists(folder_name): os.makedirs(folder_name)
 
         self.metric_save = folder_name + "metrics/"
         self.model_save = folder_name + "models/"
+        # Created only by the memmap replay buffer and by the TF profiler trace
+        self.buffer_save = folder_name + "buffers/" + self.save_tag + "/"
+        self.profile_save = folder_name + "profile/" + self.save_tag + "/"
 
         if not os.path.exists(self.metric_save): os.makedirs(self.metric_save)
         if not os.path.exists(self.model_save): os.makedirs(self.model_save)
@@ -44,6 +78,40 @@ class Tracker:
 
         self.metrics = []
         self.len_metrics = len(metrics)
+        self.on_episode = on_episode
+        self.on_save = on_save
+
+        log = log or {}
+        self.step_metrics = step_metrics or []
+        self.step_every = log.get('step_every', 0)
+        # The loops advance the steps in jumps (n_envs, collected ahead or stored by the actors)
+        self.next_log_step = self.step_every
+        self.shard_size = log.get('shard_size', 100000)
+        self.format = 'parquet' if log.get('format') == 'parquet' and has_pyarrow else 'npz'
+        self.step_rows = []
+        self.n_shards = 0
+        self.dropped = 0
+
+        self.telemetry = None
+        if telemetry and telemetry.get('every'):
+            telemetry_format = telemetry.get('format', 'jsonl')
+            if telemetry_format == 'tensorboard' and not has_tensorboard: telemetry_format = 'jsonl'
+            telemetry_path = self.metric_save + self.save_tag + '_telemetry.jsonl' if telemetry_format == 'jsonl' \
+                else folder_name + 'telemetry/' + self.save_tag + '/'
+            self.telemetry = Telemetry(
+                run_name or self.save_tag + '@' + str(os.getpid()),
+                self.step_metrics,
+                telemetry['every'],
+                telemetry_format,
+                telemetry_path,
+                telemetry.get('socket', '')
+            )
+
+        self.queue = queue.Queue(maxsize=log.get('queue_size', 1000))
+        # Set by the writer thread when it fails, raised by the next save_metrics/save_eval/close
+        self.error = None
+        self.writer = threading.Thread(target=self.write_loop, daemon=True)
+        self.writer.start()
         
     def update(self, metrics):
         """Store the training metrics
@@ -57,6 +125,34 @@ class Tracker:
 
         assert self.len_metrics == len(metrics)
         self.metrics.append(metrics)
+        if self.telemetry is not None: self.telemetry.add_episode(metrics[0], metrics[1])
+
+        if self.on_episode is not None and not self.on_episode(metrics):
+            raise StopTraining(f'stopped after the episode {metrics[0]}')
+
+    def log_step(self, step, metrics):
+        """Queue the per-step metrics, if the step reached the next multiple of step_every
+        (one row for each multiple crossed, whatever the jumps of the step). It never blocks:
+        when the writer falls behind the row is dropped (and counted)
+
+        Args:
+            step (int): current step
+            metrics (list): values of the step_metrics
+           
+        Returns:
+            None
+        """
+
+        # The telemetry keeps only the last metrics, converted when a record is due
+        if self.telemetry is not None: self.telemetry.add_step(step, metrics)
+        if not self.step_every or step < self.next_log_step: return
+        self.next_log_step = (step // self.step_every + 1) * self.step_every
+
+        assert len(self.step_metrics) == len(metrics)
+        try:
+            self.queue.put_nowait(('step', metrics))
+        except queue.Full:
+            self.dropped += 1
 
     def save_metrics(self):
         """Save the .csv
@@ -68,9 +164,155 @@ class Tracker:
             None
         """
         
-        with open(self.metric_save + self.save_tag + '.csv', 'a') as f:
-            np.savetxt(f, self.metrics, delimiter=',', fmt='%s')
-            self.metrics = []
+        # Episode rows are few, the writer thread appends them to the .csv
+        self.put(('episode', self.metrics))
+        self.metrics = []
+
+    def save_profile(self, report):
+        """Queue a profiler report, appended as a json line to the _profile.jsonl file.
+        Like log_step it never blocks
+
+        Args:
+            report (dict): report of the Profiler
+
+        Returns:
+            None
+        """
+
+        try:
+            self.queue.put_nowait(('profile', report))
+        except queue.Full:
+            self.dropped += 1
+
+    def save_eval(self, metrics):
+        """Queue the results of an evaluation (see Evaluator), appended to the _eval.jsonl file
+        (not a .csv, that generate_graphs.py would plot as a seed)
+
+        Args:
+            metrics (list): training episode, mean and std of the evaluation returns
+
+        Returns:
+            None
+        """
+
+        self.put(('eval', [metrics]))
+
+    def put(self, item):
+        """Queue an item that must not be dropped, raising the error of the writer thread if it
+        failed (e.g., on_save or a full disk) instead of waiting forever on its full queue
+
+        Args:
+            item (tuple): kind and rows of the item
+
+        Returns:
+            None
+        """
+
+        while True:
+            if self.error is not None:
+                raise RuntimeError(f'Tracker writer thread failed: {self.error!r}') from self.error
+            try:
+                self.queue.put(item, timeout=1)
+                return
+            except queue.Full:
+                pass
+
+    def write_loop(self):
+        """Writer thread: append the episode rows to the .csv and collect the step rows in shards.
+        An exception stops it and is stored in self.error
+
+        Args:
+            None
+
+        Returns:
+            None
+        """
+
+        try:
+            self.write_items()
+        except BaseException as error:
+            self.error = error
+
+    def write_items(self):
+        """Write the queued items until the 'close' one
+
+        Args:
+            None
+
+        Returns:
+            None
+        """
+
+        while True:
+            kind, rows = self.queue.get()
+
+            if kind == 'episode':
+                with open(self.metric_save + self.save_tag + '.csv', 'a') as f:
+                    np.savetxt(f, rows, delimiter=',', fmt='%s')
+                if self.on_save is not None and rows: self.on_save(rows)
+            elif kind == 'eval':
+                with open(self.metric_save + self.save_tag + '_eval.jsonl', 'a') as f:
+                    for e, mean, std in rows:
+                        f.write(json.dumps({'Epoch': int(e), 'Mean_Return': float(mean), 'Std_Return': float(std)}) + '\n')
+            elif kind == 'profile':
+                with open(self.metric_save + self.save_tag + '_profile.jsonl', 'a') as f:
+                    f.write(json.dumps(rows) + '\n')
+            elif kind == 'step':
+                self.step_rows.append([float(v) for v in rows])
+                if len(self.step_rows) >= self.shard_size: self.write_shard()
+            else:
+                if self.step_rows: self.write_shard()
+                self.queue.task_done()
+                return
+
+            self.queue.task_done()
+
+    def write_shard(self):
+        """Write the collected step rows as a columnar shard
+
+        Args:
+            None
+
+        Returns:
+            None
+        """
+
+        columns = np.array(self.step_rows, dtype=np.float64).T
+        path = self.metric_save + self.save_tag + '_steps' + str(self.n_shards)
+
+        if self.format == 'parquet':
+            import pyarrow as pa
+            import pyarrow.parquet as pq
+            table = pa.table({name: col for name, col in zip(self.step_metrics, columns)})
+            pq.write_table(table, path + '.parquet')
+        else:
+            np.savez(path + '.npz', **{name: col for name, col in zip(self.step_metrics, columns)})
+
+        self.step_rows = []
+        self.n_shards += 1
+
+    def close(self):
+        """Save the pending metrics and wait for the writer thread
+
+        Args:
+            None
+
+        Returns:
+            None
+        """
+
+        try:
+            if self.metrics: self.save_metrics()
+            self.put(('close', None))
+            self.writer.join()
+        finally:
+            if self.telemetry is not None:
+                self.telemetry.close()
+                if self.telemetry.dropped: print(f'Tracker: {self.telemetry.dropped} telemetry records not received by the monitor')
+        if self.dropped: print(f'Tracker: {self.dropped} step/profile rows dropped')
+        # The writer can fail on the last rows
+        if self.error is not None:
+            raise RuntimeError(f'Tracker writer thread failed: {self.error!r}') from self.error
 
     def save_model(self, model, epoch, success):
         """Save the model